@@ -1,20 +1,61 @@
 import codecs
 import csv
+import fcntl
+import hashlib
+import heapq
 import io
+import itertools
+import json
+import logging
+import logging.handlers
 import os
-from collections import defaultdict
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from array import array
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
 
 import falcon
+import geohash
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover
+    pyarrow = None
 
 from addok.config import config
-from addok.core import reverse, search
-from addok.helpers.text import EntityTooLarge
+from addok.core import Result, Reverse, Search, reverse
+from addok.db import DB
+from addok.ds import DS
+from addok.helpers import keys as dbkeys
+from addok.helpers.index import preprocess
+from addok.helpers.search import preprocess_query
+from addok.helpers.text import EntityTooLarge, Token, ascii, compare_ngrams
 from addok.http import View, log_notfound, log_query
 
 
 def register_http_endpoint(api):
     api.add_route("/search/csv", CSVSearch())
     api.add_route("/reverse/csv", CSVReverse())
+    api.add_route("/search/csv/jobs", CSVJobs(CSVSearch()))
+    api.add_route("/reverse/csv/jobs", CSVJobs(CSVReverse()))
+    api.add_route("/csv/jobs/{job_id}", CSVJob())
+    api.add_route("/csv/jobs/{job_id}/result", CSVJobResult())
+    api.add_route("/csv/metrics", CSVMetrics())
+    api.add_route("/csv/progress/{progress_id}", CSVProgress())
+
+
+def register_http_middleware(middlewares):
+    middlewares.append(LatencyMiddleware())
 
 
 def preconfigure(config):
@@ -40,6 +81,40 @@ def preconfigure(config):
         "result_housenumber",
     ]
     config.CSV_MIN_SCORE = 0.5
+    config.CSV_STREAM = False
+    config.CSV_CHUNK_SIZE = 64 * 1024
+    config.CSV_BATCH_SIZE = 100
+    config.CSV_WORKERS = 1
+    config.CSV_DEDUP_SIZE = 10000
+    config.CSV_CACHE_SIZE = 0
+    config.CSV_CACHE_TTL = 24 * 60 * 60
+    config.CSV_CACHE_VERSION_KEY = None
+    config.CSV_JOBS_DIR = os.path.join(tempfile.gettempdir(), "addok-csv-jobs")
+    config.CSV_JOBS_WORKERS = 2
+    config.CSV_JOBS_HEARTBEAT = 10
+    config.CSV_JOBS_TTL = 7 * 24 * 60 * 60
+    config.CSV_CHECKPOINTS_DIR = None
+    config.CSV_CHECKPOINT_INTERVAL = 10000
+    config.CSV_CHECKPOINTS_TTL = 7 * 24 * 60 * 60
+    config.CSV_REVERSE_GROUPING = False
+    config.CSV_SNIFF_SIZE = 64 * 1024
+    config.CSV_METRICS_CALLBACKS_PYPATHS = []
+    config.CSV_PROGRESS_INTERVAL = 1
+    config.CSV_PROGRESS_TTL = 3600
+    config.CSV_PROGRESS_STALL = 60
+    config.CSV_RATE_LIMIT = 0
+    config.CSV_RATE_LIMITS = {}
+    config.CSV_CONCURRENCY = 0
+    config.CSV_INTERACTIVE_LATENCY = 0
+    config.CSV_MAX_CANDIDATES = 10
+    config.CSV_HASH_COLUMN = "result_hash"
+    config.CSV_SPOOL_SIZE = 0
+    config.CSV_FILES_WORKERS = 4
+    config.CSV_STATUS_COLUMN = None
+    config.CSV_OVERSIZE = "error"
+    config.CSV_ENCODING_ERRORS = "strict"
+    config.CSV_WARMUP = False
+    config.CSV_SLOW_ROWS = 0
 
 
 @config.on_load
@@ -49,6 +124,897 @@ def on_load():
             if field.get("type") == "housenumbers":
                 continue
             config.CSV_EXTRA_FIELDS.append(field["key"])
+    CACHE.maxsize = config.CSV_CACHE_SIZE
+    CACHE.ttl = config.CSV_CACHE_TTL
+    CACHE.clear()
+    Throttle.buckets.clear()
+    Throttle.slots = None
+    if config.CSV_CONCURRENCY:
+        Throttle.slots = threading.BoundedSemaphore(config.CSV_CONCURRENCY)
+    if config.CSV_SLOW_ROWS and not slow_logger.handlers:
+        filename = Path(config.LOG_DIR).joinpath("csv_slow.log")
+        try:
+            handler = logging.handlers.TimedRotatingFileHandler(
+                str(filename), when="midnight"
+            )
+        except FileNotFoundError:
+            print("Unable to write to {}".format(filename))
+        else:
+            slow_logger.addHandler(handler)
+    WARMUP.clear()
+    if config.CSV_WARMUP:
+        warmup()
+
+
+# Duration of each step of the warmup, in seconds.
+WARMUP = {}
+
+
+def warmup():
+    """Do the work of a first request before serving any: open connections,
+    build the engine structures, resolve headers, run the whole pipeline."""
+
+    def connect():
+        # One connection per geocoding thread.
+        pool = DB.connection_pool
+        connections = [
+            pool.get_connection("PING") for _ in range(max(config.CSV_WORKERS, 1))
+        ]
+        for connection in connections:
+            pool.release(connection)
+        list(DS.fetch("warmup"))
+
+    def process(view, content):
+        file = JobFile(None, "warmup.csv")
+        file._data = content.encode()
+        req = replay_request({})
+        for _ in view.process(req, file, "utf-8", io.BytesIO()):
+            pass
+
+    steps = {
+        "redis": connect,
+        "search": lambda: process(CSVSearch(), "q\n1 rue de la gare\n"),
+        "reverse": lambda: process(CSVReverse(), "lat,lon\n48.85,2.35\n"),
+    }
+    start = time.perf_counter()
+    try:
+        for step, func in steps.items():
+            WARMUP[step] = time.perf_counter()
+            func()
+            WARMUP[step] = time.perf_counter() - WARMUP[step]
+    except Exception as e:
+        # Not ready yet, but requests will do the work anyway.
+        WARMUP.pop(step)
+        print("CSV warmup failed at {} step: {}".format(step, e))
+        return
+    print(
+        "CSV warmup done in {:.3f}s (pid {}): {}".format(
+            time.perf_counter() - start,
+            os.getpid(),
+            ", ".join("{} {:.3f}s".format(k, v) for k, v in WARMUP.items()),
+        )
+    )
+
+
+# Output formats: extension and content type.
+FORMATS = {
+    "csv": ("csv", "text/csv; charset={encoding}"),
+    "ndjson": ("ndjson", "application/x-ndjson"),
+    "geojsonseq": ("geojsons", "application/geo+json-seq"),
+    "parquet": ("parquet", "application/vnd.apache.parquet"),
+    "arrow": ("arrow", "application/vnd.apache.arrow.file"),
+    "arrows": ("arrows", "application/vnd.apache.arrow.stream"),
+}
+# Columnar formats, guessed from the extension of the uploaded file, which is
+# then returned in the same format.
+COLUMNAR_FORMATS = {
+    ".parquet": "parquet",
+    ".arrow": "arrow",
+    ".feather": "arrow",
+    ".arrows": "arrows",
+}
+
+
+def geocoded_filename(filename, extension):
+    return "{}.geocoded.{}".format(os.path.splitext(filename)[0], extension)
+
+
+def set_attachment(resp, filename, encoding, format="csv"):
+    extension, content_type = FORMATS[format]
+    attachment = 'attachment; filename="{}"'.format(
+        geocoded_filename(filename, extension)
+    )
+    resp.set_header("Content-Disposition", attachment)
+    resp.set_header("Content-Type", content_type.format(encoding=encoding))
+
+
+class ZipOutput:
+    """Write only file, so the archive can be sent while it is built."""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class CSVWriter:
+    """Write rows as lists, in fieldnames order, encoded as they are written.
+
+    A character which cannot be encoded is replaced or fails on its row,
+    according to `errors`, instead of once the whole file is geocoded.
+    """
+
+    def __init__(self, output, fieldnames, dialect, encoding, errors="strict"):
+        self.output = output
+        self.fieldnames = fieldnames
+        self.encode = codecs.getincrementalencoder(encoding)(errors).encode
+        self.writer = csv.writer(self, dialect)
+
+    def write(self, text):
+        # Called by the csv writer, once per row.
+        self.output.write(self.encode(text))
+
+    def writeheader(self):
+        self.writer.writerow(self.fieldnames)
+
+    def writerow(self, row):
+        self.writer.writerow([row.get(key, "") for key in self.fieldnames])
+
+
+class NDJSONWriter:
+    """Write rows as JSON objects, one per line, with typed result values."""
+
+    def __init__(self, output, fieldnames, numerics):
+        self.output = output
+        self.fieldnames = fieldnames
+        self.numerics = numerics
+
+    def writeheader(self):
+        pass
+
+    def convert(self, row):
+        data = {}
+        for key in self.fieldnames:
+            value = row.get(key)
+            if value == "":
+                value = None
+            elif value is not None and key in self.numerics:
+                try:
+                    value = self.numerics[key](value)
+                except ValueError:
+                    pass
+            data[key] = value
+        return data
+
+    def writerow(self, row):
+        line = json.dumps(self.convert(row), ensure_ascii=False) + "\n"
+        self.output.write(line.encode())
+
+    def writeerror(self, message):
+        # Last record of a stream interrupted by an error.
+        line = json.dumps({"error": message}, ensure_ascii=False) + "\n"
+        self.output.write(line.encode())
+
+
+class GeoJSONSeqWriter(NDJSONWriter):
+    """Write rows as GeoJSON features, as per RFC 8142."""
+
+    def __init__(self, output, fieldnames, numerics, coordinates):
+        super().__init__(output, fieldnames, numerics)
+        self.coordinates = coordinates
+
+    def writerow(self, row):
+        properties = self.convert(row)
+        lon, lat = (properties.get(key) for key in self.coordinates)
+        geometry = None
+        if isinstance(lon, float) and isinstance(lat, float):
+            geometry = {"type": "Point", "coordinates": [lon, lat]}
+        feature = {"type": "Feature", "geometry": geometry, "properties": properties}
+        line = "\x1e" + json.dumps(feature, ensure_ascii=False) + "\n"
+        self.output.write(line.encode())
+
+    def writeerror(self, message):
+        self.output.write(b"\x1e")
+        super().writeerror(message)
+
+
+class ColumnarReader:
+    """Iterate over Arrow record batches, as rows of strings.
+
+    Each batch is handed to `writer` before its rows, so it can write it back
+    with the results once all its rows have been processed.
+    """
+
+    def __init__(self, batches, schema, writer):
+        self.batches = iter(batches)
+        self.fieldnames = schema.names
+        self.writer = writer
+        self.rows = iter(())
+        # Rows read so far, like csv readers' line_num.
+        self.line_num = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            try:
+                row = next(self.rows)
+            except StopIteration:
+                pass
+            else:
+                self.line_num += 1
+                return row
+            batch = next(self.batches)
+            if not batch.num_rows:
+                continue
+            self.writer.pending.append(batch)
+            rows = batch.to_pylist()
+            self.rows = iter(
+                [{k: "" if v is None else str(v) for k, v in r.items()} for r in rows]
+            )
+
+
+class ColumnarWriter:
+    """Write record batches, with the results headers as typed columns."""
+
+    TYPES = {float: "float64", int: "int64", str: "string"}
+
+    def __init__(self, output, format, schema, headers, numerics):
+        self.headers = headers
+        self.converters = {key: numerics.get(key, str) for key in headers}
+        for key, converter in self.converters.items():
+            field = pyarrow.field(key, getattr(pyarrow, self.TYPES[converter])())
+            index = schema.get_field_index(key)
+            if index == -1:
+                schema = schema.append(field)
+            else:
+                # Same behaviour as for CSV: result value replaces input one.
+                schema = schema.set(index, field)
+        self.schema = schema
+        if format == "parquet":
+            self.writer = pyarrow.parquet.ParquetWriter(output, schema)
+        elif format == "arrow":
+            self.writer = pyarrow.ipc.new_file(output, schema)
+        else:
+            self.writer = pyarrow.ipc.new_stream(output, schema)
+        self.pending = deque()
+        self.values = {key: [] for key in headers}
+        self.count = 0
+
+    def writeheader(self):
+        pass
+
+    def writerow(self, row):
+        for key, converter in self.converters.items():
+            value = row.get(key)
+            self.values[key].append(None if value in (None, "") else converter(value))
+        self.count += 1
+        if self.count == self.pending[0].num_rows:
+            self.flush()
+
+    def flush(self):
+        batch = self.pending.popleft()
+        arrays = []
+        for field in self.schema:
+            if field.name in self.values:
+                arrays.append(pyarrow.array(self.values[field.name], field.type))
+            else:
+                arrays.append(batch.column(field.name))
+        self.writer.write_batch(
+            pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema)
+        )
+        self.values = {key: [] for key in self.headers}
+        self.count = 0
+
+    def close(self):
+        self.writer.close()
+
+
+class PrefetchedToken(Token):
+
+    __slots__ = ()
+
+    def search(self):
+        # Tokens keys are sorted sets, so the key exists if and only if its
+        # cardinality (aka frequency, which has been prefetched) is not null.
+        if self.frequency:
+            self.db_key = self.key
+
+
+class BatchSearch(Search):
+    """Search using the token frequencies prefetched for a batch of rows.
+
+    In structured mode, the housenumber is given apart from the query, and
+    the other fields are compared to the ones of the results.
+    """
+
+    def __init__(self, frequencies, **kwargs):
+        super().__init__(**kwargs)
+        self.frequencies = frequencies
+        # Key of the temporary values in Redis (eg. for fuzzy): by default the
+        # pid, shared by all the threads geocoding rows, files or jobs.
+        self.pid = "{}|{}".format(os.getpid(), uuid.uuid4().hex)
+
+    def __call__(self, query, lat=None, lon=None, structure=None, **filters):
+        self.structure = dict(structure or {})
+        housenumber = self.structure.pop("housenumber", "").strip()
+        # Tokenized as when indexed, so "12 bis" matches as a whole.
+        self.housenumbers_tokens = []
+        for token in preprocess(housenumber) if housenumber else []:
+            token = token.update(token, kind="housenumber")
+            # Housenumbers are not indexed, no need to ask Redis.
+            token._frequency = 0
+            token.__class__ = PrefetchedToken
+            self.housenumbers_tokens.append(token)
+        return super().__call__(query, lat, lon, **filters)
+
+    @property
+    def tokens(self):
+        return self._tokens
+
+    @tokens.setter
+    def tokens(self, tokens):
+        if self.housenumbers_tokens:
+            # Given housenumber is the only one, whatever the query looks like.
+            for token in tokens:
+                if token.kind == "housenumber":
+                    token.kind = None
+            tokens = self.housenumbers_tokens + tokens
+            self.housenumbers_tokens = []
+        for token in tokens:
+            if type(token) is Token and token.key in self.frequencies:
+                token._frequency = self.frequencies[token.key]
+                token.__class__ = PrefetchedToken
+        self._tokens = tokens
+
+    def render(self):
+        if self.structure:
+            self.convert()
+            for result in self.results.values():
+                self.score_by_structure(result)
+        return super().render()
+
+    def score_by_structure(self, result):
+        for field, value in self.structure.items():
+            candidate = getattr(result, field, "")
+            # Not comparable when the result has no such field (eg. a city
+            # has no street).
+            if value and candidate:
+                result.add_score(field, compare_ngrams(value, str(candidate)), 1)
+
+
+def prefetch_frequencies(queries):
+    """Get the frequency of all the tokens of `queries` in one round-trip."""
+    keys = set()
+    for query in queries:
+        try:
+            tokens = preprocess_query(ascii(query.strip()))
+        except EntityTooLarge:
+            # Will be raised again, with row number, at search time.
+            continue
+        keys.update(dbkeys.token_key(token) for token in tokens)
+    keys = list(keys)
+    pipe = DB.pipeline(transaction=False)
+    for key in keys:
+        pipe.zcard(key)
+    return dict(zip(keys, pipe.execute()))
+
+
+class CellReverse(Reverse):
+    """Reverse geocode points of a same geohash cell, fetching candidates once.
+
+    Candidates only depend on the cell of the point (and on filters), so only
+    distances and scores are computed for each point.
+    """
+
+    def __init__(self, geoh, limit=1, **filters):
+        super().__init__(verbose=False)
+        self.keys = set([])
+        self.wanted = limit
+        self.fetched = []
+        self.check_housenumber = filters.get("type") in [None, "housenumber"]
+        self.filters = [dbkeys.filter_key(k, v) for k, v in filters.items()]
+        hashes = self.expand([geoh])
+        self.fetch(hashes)
+        if not self.keys:
+            hashes = self.expand(hashes)
+            self.fetch(hashes)
+        self.blobs = [blob for _, blob in DS.fetch(*self.keys)] if self.keys else []
+
+    def __call__(self, lat, lon):
+        self.lat = lat
+        self.lon = lon
+        results = []
+        for blob in self.blobs:
+            # Processors do alter the document, so deserialize a new one.
+            result = Result(config.DOCUMENT_SERIALIZER.loads(blob))
+            for processor in config.REVERSE_RESULT_PROCESSORS:
+                processor(self, result)
+            results.append(result)
+        results.sort(key=lambda r: r.score, reverse=True)
+        return results[: self.wanted]
+
+
+class LRUCache:
+    """Thread safe, size bounded mapping, counting hits and misses.
+
+    When `ttl` is given, entries older than `ttl` seconds are ignored.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = None
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            try:
+                value, expire = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expire is not None and expire < time.monotonic():
+                del self.data[key]
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expire = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            self.data[key] = (value, expire)
+            self.data.move_to_end(key)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def check_version(self, version):
+        # Drop everything when the version changes, eg. after a data reload.
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+
+# Shared by all the requests of the process.
+CACHE = LRUCache(0)
+
+
+class Metrics:
+    """Time spent in each stage of the processing, and rows counters."""
+
+    STAGES = ("decode", "sniff", "parse", "prepare", "geocode", "write", "encode")
+    COUNTERS = {
+        "rows": "Rows processed",
+        "skipped": "Rows with an up to date result from a previous run",
+        "matched": "Rows with a result (above min_score for search)",
+        "notfound": "Rows without result",
+        "empty": "Rows with an empty query, or without valid coordinates",
+        "oversize": "Rows with a query too long, truncated or skipped",
+    }
+
+    def __init__(self):
+        self.timings = dict.fromkeys(self.STAGES, 0.0)
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.requests = 0
+        # Heap of the slowest engine calls: (duration, query, filters).
+        self.slowest = []
+        # Rows may be processed by many threads.
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] += time.perf_counter() - start
+
+    def incr(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def engine(self, compute, query, filters):
+        """Call the engine, keep the call if among the CSV_SLOW_ROWS slowest."""
+        if not config.CSV_SLOW_ROWS:
+            return compute()
+        start = time.perf_counter()
+        try:
+            return compute()
+        finally:
+            entry = (time.perf_counter() - start, query, tuple(sorted(filters.items())))
+            with self.lock:
+                self.push_slow(entry)
+
+    def push_slow(self, entry):
+        if len(self.slowest) < config.CSV_SLOW_ROWS:
+            heapq.heappush(self.slowest, entry)
+        elif entry > self.slowest[0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def merge(self, other):
+        with self.lock:
+            self.requests += 1
+            for stage, duration in other.timings.items():
+                self.timings[stage] += duration
+            for counter, value in other.counters.items():
+                self.counters[counter] += value
+            for entry in other.slowest:
+                self.push_slow(entry)
+
+    def as_dict(self):
+        data = {"timings": self.timings, "counters": self.counters}
+        if config.CSV_SLOW_ROWS:
+            data["slowest"] = [
+                {"query": query, "filters": dict(filters), "duration": duration}
+                for duration, query, filters in sorted(self.slowest, reverse=True)
+            ]
+        return data
+
+    def set_headers(self, resp):
+        timings = ", ".join(
+            "{};dur={:.1f}".format(stage, duration * 1000)
+            for stage, duration in self.timings.items()
+        )
+        resp.set_header("Server-Timing", timings)
+        resp.set_header("X-Rows", str(self.counters["rows"]))
+        resp.set_header("X-Rows-Matched", str(self.counters["matched"]))
+        resp.set_header("X-Rows-Not-Found", str(self.counters["notfound"]))
+        resp.set_header("X-Rows-Empty", str(self.counters["empty"]))
+        resp.set_header("X-Rows-Skipped", str(self.counters["skipped"]))
+        resp.set_header("X-Rows-Oversize", str(self.counters["oversize"]))
+
+
+# Totals by endpoint, since the process started.
+METRICS = defaultdict(Metrics)
+
+
+slow_logger = logging.getLogger("csv_slow")
+slow_logger.setLevel(logging.DEBUG)
+
+
+def report_metrics(endpoint, metrics):
+    METRICS[endpoint].merge(metrics)
+    for duration, query, filters in sorted(metrics.slowest, reverse=True):
+        slow_logger.debug(
+            "\t".join(
+                [
+                    endpoint,
+                    "{:.1f}".format(duration * 1000),
+                    query,
+                    json.dumps(dict(filters), ensure_ascii=False),
+                ]
+            )
+        )
+    for callback in config.CSV_METRICS_CALLBACKS:
+        callback(endpoint, metrics)
+
+
+class Latency:
+    """Moving average of the duration of interactive requests.
+
+    Batch requests are slowed down while it is above
+    CSV_INTERACTIVE_LATENCY, and gradually sped up again once it is below.
+
+    The worker running a batch does not serve interactive requests meanwhile
+    (eg. with sync workers), so the factor is shared in Redis by all the
+    workers, and expires when there are no more interactive requests. It
+    moves by one step per INTERVAL, whatever the traffic, and is only
+    published then.
+    """
+
+    KEY = "csv|latency|factor"
+    TTL = 60
+    # Seconds between two steps of the factor.
+    INTERVAL = 1
+    average = 0.0
+    # Factor computed from the requests served by this process.
+    own = 1.0
+    # When it was last stepped, and published.
+    stepped = 0.0
+    # Ratio applied to the rate of the batch requests, as read from Redis.
+    factor = 1.0
+    # When the factor was last read from Redis.
+    fetched = 0.0
+
+    @classmethod
+    def add(cls, duration):
+        cls.average = cls.average * 0.9 + duration * 0.1
+        target = config.CSV_INTERACTIVE_LATENCY
+        if not target:
+            return
+        now = time.monotonic()
+        if now - cls.stepped < cls.INTERVAL:
+            return
+        if now - cls.stepped > cls.TTL:
+            # Published value has expired, start again from there.
+            cls.own = 1.0
+        cls.stepped = now
+        if cls.average > target:
+            cls.own = max(cls.own / 2, 0.05)
+        else:
+            cls.own = min(cls.own + 0.05, 1.0)
+        DB.set(cls.KEY, cls.own, ex=cls.TTL)
+
+    @classmethod
+    def current(cls):
+        if not config.CSV_INTERACTIVE_LATENCY:
+            return 1.0
+        # Read by every engine call: only ask Redis once a second.
+        now = time.monotonic()
+        if now - cls.fetched >= 1:
+            cls.fetched = now
+            value = DB.get(cls.KEY)
+            cls.factor = float(value) if value else 1.0
+        return cls.factor
+
+
+class LatencyMiddleware:
+    def process_request(self, req, resp):
+        req.context.start = time.perf_counter()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        # Only measure interactive requests.
+        if resource is None or isinstance(resource, (BaseCSV, CSVJobs, CSVProgress)):
+            return
+        Latency.add(time.perf_counter() - req.context.start)
+
+
+class Throttle:
+    """Token bucket limiting the engine calls of a client on an endpoint.
+
+    Results found in caches are not counted.
+    """
+
+    buckets = LRUCache(1000)
+    # Limit of engine calls running at the same time, by all clients.
+    slots = None
+    lock = threading.Lock()
+
+    def __init__(self, rate):
+        self.rate = rate
+        # Allow bursts of one second.
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls, endpoint, client):
+        rate = config.CSV_RATE_LIMITS.get(endpoint, config.CSV_RATE_LIMIT)
+        if not rate:
+            return None
+        with cls.lock:
+            throttle = cls.buckets.get((endpoint, client))
+            if throttle is None or throttle.rate != rate:
+                throttle = cls(rate)
+                cls.buckets.set((endpoint, client), throttle)
+        return throttle
+
+    def acquire(self):
+        rate = self.rate * Latency.current()
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.updated
+            self.updated = now
+            self.tokens = min(self.tokens + elapsed * rate, rate) - 1
+            # Tokens may go negative: each caller waits for its own.
+            wait = -self.tokens / rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+    @classmethod
+    def run(cls, throttle, compute):
+        if throttle:
+            throttle.acquire()
+        if cls.slots is None:
+            return compute()
+        with cls.slots:
+            return compute()
+
+
+class Checkpoint:
+    """Rows processed so far by a run, saved on disk to be able to resume it.
+
+    Rows are appended, as CSV, to `rows.csv`, and `state.json` keeps the count
+    and size of the rows safely written, so a partial write is just ignored.
+    """
+
+    def __init__(self, key, fieldnames):
+        self.path = Path(config.CSV_CHECKPOINTS_DIR) / key
+        self.fieldnames = fieldnames
+        self.pending = []
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.lock = self.path.joinpath("lock").open("w")
+        # Only one run at a time, the lock is released if the process dies.
+        try:
+            fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock.close()
+            raise
+        try:
+            with self.path.joinpath("state.json").open() as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            state = {"rows": 0, "size": 0}
+        self.rows = state["rows"]
+        self.file = self.path.joinpath("rows.csv").open("a+b")
+        self.file.truncate(state["size"])
+
+    @classmethod
+    def open(cls, key, fieldnames):
+        cls.clean()
+        try:
+            return cls(key, fieldnames)
+        except BlockingIOError:
+            # Same file is being processed by another run, don't mess with it.
+            return None
+
+    @classmethod
+    def clean(cls):
+        """Remove checkpoints not written for CSV_CHECKPOINTS_TTL seconds."""
+        root = Path(config.CSV_CHECKPOINTS_DIR)
+        if not config.CSV_CHECKPOINTS_TTL or not root.is_dir():
+            return
+        for path in root.iterdir():
+            try:
+                written = max(p.stat().st_mtime for p in path.iterdir())
+            except (OSError, ValueError):
+                # Being created, or removed by another process.
+                continue
+            if time.time() - written <= config.CSV_CHECKPOINTS_TTL:
+                continue
+            try:
+                with path.joinpath("lock").open("w") as lock:
+                    # Not if a run is using it.
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                # Locked by a run, or removed by another process.
+                continue
+
+    def saved(self):
+        with self.path.joinpath("rows.csv").open(encoding="utf-8", newline="") as f:
+            reader = csv.DictReader(f, self.fieldnames)
+            yield from itertools.islice(reader, self.rows)
+
+    def add(self, rows):
+        self.pending.extend(rows)
+        if len(self.pending) >= config.CSV_CHECKPOINT_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, self.fieldnames, extrasaction="ignore")
+        writer.writerows(self.pending)
+        self.file.write(buffer.getvalue().encode("utf-8"))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.rows += len(self.pending)
+        self.pending = []
+        tmp = self.path.joinpath("state.json.tmp")
+        with tmp.open("w") as f:
+            json.dump({"rows": self.rows, "size": self.file.tell()}, f)
+        os.replace(tmp, self.path.joinpath("state.json"))
+
+    def close(self, done=False):
+        if done:
+            shutil.rmtree(self.path)
+        else:
+            self.flush()
+        self.file.close()
+        self.lock.close()
+
+
+def compute_progress(rows, ratio, start):
+    elapsed = time.monotonic() - start
+    return {
+        "rows": rows,
+        "rows_per_second": round(rows / elapsed, 1) if elapsed else None,
+        "progress": round(ratio, 4) if ratio is not None else None,
+        "eta": round(elapsed * (1 - ratio) / ratio, 1) if ratio else None,
+    }
+
+
+class Progress:
+    """Publish in Redis the progress of a file being processed, by id.
+
+    So any worker can answer to `/csv/progress/{id}`, not only the one
+    processing the file.
+    """
+
+    ID = re.compile(r"[\w-]{1,64}")
+
+    def __init__(self, id, total=None, position=None):
+        self.key = "csv|progress|{}".format(id)
+        # Total number of lines of the file, or of bytes when the file is
+        # streamed, if known.
+        self.total = total
+        # Bytes read so far, when the file is streamed.
+        self.position = position
+        self.start = self.last = time.monotonic()
+        self.publish("running", 0, 0)
+
+    @classmethod
+    def load(cls, id):
+        if not cls.ID.fullmatch(id):
+            return None
+        data = DB.get("csv|progress|{}".format(id))
+        return json.loads(data) if data else None
+
+    def publish(self, status, rows, consumed):
+        ratio = consumed / self.total if self.total else None
+        data = dict(status=status, **compute_progress(rows, ratio, self.start))
+        DB.set(self.key, json.dumps(data), ex=config.CSV_PROGRESS_TTL)
+
+    def update(self, rows, consumed):
+        if time.monotonic() - self.last >= config.CSV_PROGRESS_INTERVAL:
+            self.last = time.monotonic()
+            if self.position:
+                consumed = min(self.position(), self.total or 0)
+            self.publish("running", rows, consumed)
+
+    def close(self, rows, done):
+        if done:
+            self.publish("done", rows, self.total)
+        else:
+            self.publish("failed", rows, 0)
+
+
+class RowPlan:
+    """Everything the rows processing needs that does not change between rows.
+
+    Built once per request, so request parameters, filters and extra fields
+    are not resolved again for each row.
+    """
+
+    def __init__(self, req, filters, columns):
+        self.columns = columns
+        self.filters = tuple(filters.items())
+        self.extra_fields = tuple(
+            (key, "result_{}".format(key)) for key in config.CSV_EXTRA_FIELDS
+        )
+        self.min_score = req.get_param_as_float(
+            "min_score", default=config.CSV_MIN_SCORE
+        )
+        lat = req.get_param("lat")
+        lon = req.get_param("lon")
+        self.center = (lat, lon) if lat and lon else None
+        # Resolved from the first row, see `resolve`.
+        self.resolved = False
+
+    def resolve(self, row, **candidates):
+        """Set, as attributes, the first of each candidate columns in `row`."""
+        for name, keys in candidates.items():
+            setattr(self, name, next((k for k in keys if k in row), None))
+        self.resolved = True
 
 
 class BaseCSV(View):
@@ -69,9 +1035,48 @@ class BaseCSV(View):
         content = content.replace("\r", "").replace("\n", "\r\n")
         return content
 
+    def compute_stream(self, req, file, encoding):
+        # Same as compute_content, but chunk by chunk: yield normalized lines
+        # without ever holding the whole file in memory.
+        try:
+            decoder = codecs.getincrementaldecoder(encoding)()
+        except LookupError as e:
+            msg = 'Unable to decode with encoding "{}"'.format(encoding)
+            raise falcon.HTTPBadRequest(title=msg, description=str(e))
+        remainder = ""
+        # Bytes read so far, for the progress.
+        file.consumed = 0
+        while True:
+            chunk = file.stream.read(config.CSV_CHUNK_SIZE)
+            file.consumed += len(chunk)
+            try:
+                content = decoder.decode(chunk, final=not chunk)
+            except UnicodeDecodeError as e:
+                msg = 'Unable to decode with encoding "{}"'.format(encoding)
+                raise falcon.HTTPBadRequest(title=msg, description=str(e))
+            content = content.replace("\r", "").replace("\n", "\r\n")
+            lines = (remainder + content).splitlines(keepends=True)
+            remainder = ""
+            if chunk and lines and lines[-1].splitlines()[0] == lines[-1]:
+                # Last line is not complete yet, wait for next chunk.
+                remainder = lines.pop()
+            yield from lines
+            if not chunk:
+                break
+
+    def compute_sample(self, req, file):
+        sample = file.data[: config.CSV_SNIFF_SIZE]
+        if len(sample) < len(file.data):
+            # Do not give the sniffer a truncated last line.
+            end = sample.rfind("\n")
+            if end > 0:
+                sample = sample[: end + 1]
+        return sample
+
     def compute_dialect(self, req, file, encoding):
+        sample = self.compute_sample(req, file)
         try:
-            dialect = csv.Sniffer().sniff(file.data)
+            dialect = csv.Sniffer().sniff(sample)
         except csv.Error:
             dialect = csv.unix_dialect()
 
@@ -92,20 +1097,47 @@ class BaseCSV(View):
         if dialect.delimiter.isalnum() or dialect.delimiter == "\r":
             # We guess we are in one column file, let's try to use a character
             # that will not be in the file content.
-            for char in r";,\t|~^°":
-                if char not in file.data:
-                    dialect.delimiter = char
-                    break
-            else:
+            chars = [c for c in r";,\t|~^°" if c not in sample]
+            if getattr(file, "head", False):
+                # Only the head is loaded, scan the rest of the upload.
+                chars = [c for c in chars if c not in file.data]
+                if not getattr(file.stream, "seekable", lambda: False)():
+                    # Cannot be scanned without consuming it: do not guess
+                    # from the head, the delimiter could be further.
+                    chars = []
+                elif chars:
+                    chars = self.scan_stream(file, encoding, chars)
+            # Only scan the whole file for characters not in the sample, and
+            # stop at the first one not in it.
+            char = next((c for c in chars if c not in file.data), None)
+            if char is None:
                 raise falcon.HTTPBadRequest(
                     self.MISSING_DELIMITER_MSG, self.MISSING_DELIMITER_MSG
                 )
+            dialect.delimiter = char
 
         return dialect
 
+    def scan_stream(self, file, encoding, chars):
+        """Return the `chars` which are not in a seekable upload."""
+        stream = file.stream
+        position = stream.tell()
+        # Decoding errors are raised when parsing.
+        decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        stream.seek(0)
+        try:
+            for chunk in iter(lambda: stream.read(config.CSV_CHUNK_SIZE), b""):
+                content = decoder.decode(chunk)
+                chars = [c for c in chars if c not in content]
+                if not chars:
+                    break
+        finally:
+            # Parsing goes on from where the head ends.
+            stream.seek(position)
+        return chars
+
     def compute_rows(self, req, file, dialect):
-        # Keep ends, not to glue lines when a field is multilined.
-        return csv.DictReader(file.data.splitlines(keepends=True), dialect=dialect)
+        return csv.DictReader(file.lines, dialect=dialect)
 
     def compute_fieldnames(self, req, file, rows):
         fieldnames = rows.fieldnames[:]
@@ -116,73 +1148,489 @@ class BaseCSV(View):
                     column, fieldnames
                 )
                 raise falcon.HTTPBadRequest(title=msg)
-        for key in self.result_headers:
+        for key in self.compute_result_headers(req):
             if key not in fieldnames:
                 fieldnames.append(key)
         return fieldnames, columns
 
     def compute_output(self, req):
-        return io.StringIO()
+        # Writers encode the rows, so the output only holds bytes.
+        return io.BytesIO()
+
+    def compute_spooled_output(self, req):
+        return tempfile.SpooledTemporaryFile(config.CSV_SPOOL_SIZE)
+
+    def compute_format(self, req):
+        format = req.get_param("format", default="csv")
+        if format not in FORMATS:
+            msg = "Unknown format '{}', must be one of {}".format(
+                format, ", ".join(FORMATS)
+            )
+            raise falcon.HTTPBadRequest(title=msg)
+        return format
+
+    def compute_output_encoding(self, req, encoding):
+        # JSON is always UTF-8.
+        return encoding if self.compute_format(req) == "csv" else "utf-8"
 
     def compute_writer(self, req, output, fieldnames, dialect, encoding):
+        format = self.compute_format(req)
+        if format == "ndjson":
+            return NDJSONWriter(output, fieldnames, self.compute_numeric_headers(req))
+        if format == "geojsonseq":
+            return GeoJSONSeqWriter(
+                output,
+                fieldnames,
+                self.compute_numeric_headers(req),
+                self.coordinates_headers,
+            )
+        errors = config.CSV_ENCODING_ERRORS
+        writer = CSVWriter(output, fieldnames, dialect, encoding, errors)
         if encoding.startswith("utf-8") and req.get_param_as_bool("with_bom"):
             # Make Excel happy with UTF-8
-            output.write(codecs.BOM_UTF8.decode("utf-8"))
-        writer = csv.DictWriter(
-            output, fieldnames, dialect=dialect, extrasaction="ignore"
-        )
+            writer.write(codecs.BOM_UTF8.decode("utf-8"))
         writer.writeheader()
         return writer
 
     def process_rows(self, req, writer, rows, filters, columns):
-        for i, row in enumerate(rows):
-            self.process_row(req, row, filters, columns, i)
-            writer.writerow(row)
+        # Yield after each row, so the caller can flush the output if needed.
+        executor = None
+        mapper = map
+        if config.CSV_WORKERS > 1:
+            executor = ThreadPoolExecutor(config.CSV_WORKERS)
+            mapper = executor.map
+
+        req.context.plan = self.compute_plan(req, filters, columns)
+        metrics = req.context.metrics
+
+        def process(row, index):
+            self.process_row(req, row, filters, columns, index)
+
+        checkpoint = getattr(req.context, "checkpoint", None)
+        progress = getattr(req.context, "progress", None)
+        done = False
+        i = 0
+        try:
+            if checkpoint and checkpoint.rows:
+                # Resuming: output the rows already geocoded by a previous run.
+                skipped = itertools.islice(rows, checkpoint.rows)
+                for _, row in zip(skipped, checkpoint.saved()):
+                    with metrics.timer("write"):
+                        writer.writerow(row)
+                    metrics.incr("rows")
+                    yield i
+                    i += 1
+            size = max(config.CSV_BATCH_SIZE, 1)
+            while True:
+                with metrics.timer("parse"):
+                    batch = list(itertools.islice(rows, size))
+                if not batch:
+                    break
+                with metrics.timer("prepare"):
+                    self.prepare_batch(req, batch, filters, columns)
+                indexes = range(i, i + len(batch))
+                # Results come back in input order, and so do exceptions: an
+                # error on a row is raised only once previous rows are written.
+                processed = zip(batch, mapper(process, batch, indexes))
+                while True:
+                    with metrics.timer("geocode"):
+                        row, _ = next(processed, (None, None))
+                    if row is None:
+                        break
+                    with metrics.timer("write"):
+                        writer.writerow(row)
+                    metrics.incr("rows")
+                    yield i
+                    i += 1
+                if checkpoint:
+                    checkpoint.add(batch)
+                if progress:
+                    progress.update(i, rows.line_num)
+            done = True
+        finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
+            if checkpoint:
+                checkpoint.close(done)
+            if progress:
+                progress.close(i, done)
+
+    def compute_plan(self, req, filters, columns):
+        return RowPlan(req, filters, columns)
+
+    def prepare_batch(self, req, rows, filters, columns):
+        pass
+
+    def flush_output(self, req, output):
+        # Rows are already encoded, only reuse the buffer for the next chunk.
+        with req.context.metrics.timer("encode"):
+            chunk = output.getvalue()
+            output.seek(0)
+            output.truncate()
+        return chunk
+
+    def stream_output(self, req, processed, output, size):
+        sent = False
+        try:
+            for _ in processed:
+                if output.tell() >= size:
+                    yield self.flush_output(req, output)
+                    sent = True
+        except falcon.HTTPError as e:
+            writer = req.context.writer
+            # Before the first chunk, the error is still a proper response.
+            if not sent or not hasattr(writer, "writeerror"):
+                raise
+            # Status is already sent: end the stream with an error record.
+            writer.writeerror(e.title)
+        yield self.flush_output(req, output)
+        report_metrics(self.endpoint, req.context.metrics)
 
     def parse_multipart(self, req):
         # TODO move out from Falcon.
         form = defaultdict(list)
-        file = None
+        files = []
         for part in req.get_media():
-            if part.name == "data" and not file:
-                file = part
+            if part.name == "data":
+                files.append(part)
+                if config.CSV_STREAM:
+                    # The file will be consumed lazily, so it must be the last
+                    # part of the form: stop parsing here.
+                    break
                 # Force reading the stream, otherwise Falcon will consume it while
                 # parsing the rest of the multipart body…
-                file.data
+                if config.CSV_SPOOL_SIZE:
+                    self.spool(part)
+                else:
+                    part.data
             else:
                 form[part.name].append(part.text)
         req._params = form
-        return file
+        req.context.files = files
+        return files[0] if files else None
 
-    def on_post(self, req, resp, **kwargs):
-        file = self.parse_multipart(req)
-        if not file:
+    def expand_archives(self, files):
+        """Replace zip archives by the files they contain."""
+        for file in files:
+            if os.path.splitext(file.filename)[1].lower() != ".zip":
+                yield file
+                continue
+            if file._data is None and not file.stream.seekable():
+                # Zip archives need random access.
+                self.spool(file)
+            source = file.stream if file._data is None else io.BytesIO(file._data)
+            try:
+                archive = zipfile.ZipFile(source)
+            except zipfile.BadZipFile:
+                msg = "Invalid zip file '{}'".format(file.filename)
+                raise falcon.HTTPBadRequest(title=msg)
+            for info in archive.infolist():
+                name = os.path.basename(info.filename)
+                if info.is_dir() or name.startswith(".") or "__MACOSX" in info.filename:
+                    continue
+                # Seeking a member to its end would decompress it.
+                yield JobFile(archive.open(info), name, size=info.file_size)
+
+    def process_file(self, req, file):
+        """Process one of the files of a request, return its result on disk."""
+        # Each file has its own request context: dialect, caches, metrics…
+        params = {k: v for k, v in req._params.items() if k != "progress_id"}
+        sub = replay_request(params, req.remote_addr)
+        columnar = self.compute_columnar_format(sub, file)
+        encoding = sub.get_param("encoding", default=config.CSV_ENCODING)
+        format = columnar or self.compute_format(sub)
+        spool = tempfile.SpooledTemporaryFile(config.CSV_SPOOL_SIZE)
+        # Parts already read in memory are not streamed.
+        stream = file._data is None
+        try:
+            for _ in self.process(sub, file, encoding, spool, stream):
+                pass
+        except UnicodeEncodeError:
+            msg = "Wrong encoding for '{}'".format(file.filename)
+            raise falcon.HTTPBadRequest(title=msg)
+        except falcon.HTTPError as e:
+            e.title = "{}: {}".format(file.filename, e.title)
+            raise
+        spool.seek(0)
+        return geocoded_filename(file.filename, FORMATS[format][0]), spool, sub
+
+    def process_files(self, req, resp, files):
+        with ThreadPoolExecutor(max(config.CSV_FILES_WORKERS, 1)) as executor:
+            results = list(executor.map(lambda f: self.process_file(req, f), files))
+        if not results:
             raise falcon.HTTPBadRequest(title="Missing file")
-        encoding = req.get_param("encoding", default=config.CSV_ENCODING)
-        file._data = self.compute_content(req, file, encoding)
+        metrics = Metrics()
+        for _, _, sub in results:
+            report_metrics(self.endpoint, sub.context.metrics)
+            metrics.merge(sub.context.metrics)
+        metrics.set_headers(resp)
+        resp.stream = self.stream_archive([(name, spool) for name, spool, _ in results])
+        resp.content_type = "application/zip"
+        name = "files"
+        if len(req.context.files) == 1:
+            name = os.path.splitext(req.context.files[0].filename)[0]
+        attachment = 'attachment; filename="{}.geocoded.zip"'.format(name)
+        resp.set_header("Content-Disposition", attachment)
+
+    def stream_archive(self, results):
+        output = ZipOutput()
+        names = set()
+        with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as archive:
+            for name, spool in results:
+                base, _, extension = name.rpartition(".geocoded.")
+                i = 1
+                while name in names:
+                    i += 1
+                    name = "{}-{}.geocoded.{}".format(base, i, extension)
+                names.add(name)
+                with spool, archive.open(name, "w", force_zip64=True) as dest:
+                    for chunk in iter(lambda: spool.read(config.CSV_CHUNK_SIZE), b""):
+                        dest.write(chunk)
+                        yield output.pop()
+        # Central directory.
+        yield output.pop()
+
+    def spool(self, file):
+        """Copy the upload to a temporary file, if it is too big for memory."""
+        spool = tempfile.SpooledTemporaryFile(config.CSV_SPOOL_SIZE)
+        shutil.copyfileobj(file.stream, spool, config.CSV_CHUNK_SIZE)
+        file.spooled = spool.tell() > config.CSV_SPOOL_SIZE
+        spool.seek(0)
+        if file.spooled:
+            # Will be read and decoded chunk by chunk, as in streaming mode.
+            file.stream = spool
+        else:
+            file._data = spool.read()
+
+    def compute_checkpoint_key(self, req, file, stream):
+        # Same file with same parameters on same endpoint, same output.
+        key = hashlib.sha256(self.endpoint.encode())
+        # The progress id of a retry may change, the output does not.
+        params = {k: v for k, v in req.params.items() if k != "progress_id"}
+        key.update(json.dumps(params, sort_keys=True).encode())
+        if not stream:
+            key.update(file.data)
+        elif getattr(file.stream, "seekable", lambda: False)():
+            for chunk in iter(lambda: file.stream.read(config.CSV_CHUNK_SIZE), b""):
+                key.update(chunk)
+            file.stream.seek(0)
+        else:
+            # Would need to consume the upload before processing it.
+            return None
+        return key.hexdigest()
+
+    def process(self, req, file, encoding, output, stream=False):
+        """Prepare the whole pipeline, return the generator of processed rows."""
+        req.context.dedup = LRUCache(config.CSV_DEDUP_SIZE)
+        req.context.metrics = Metrics()
+        req.context.throttle = Throttle.get(self.endpoint, req.remote_addr)
+        if CACHE.maxsize and config.CSV_CACHE_VERSION_KEY:
+            CACHE.check_version(DB.get(config.CSV_CACHE_VERSION_KEY))
+        checkpoint_key = None
+        if config.CSV_CHECKPOINTS_DIR:
+            checkpoint_key = self.compute_checkpoint_key(req, file, stream)
+        columnar = self.compute_columnar_format(req, file)
+        if columnar:
+            return self.process_columnar(
+                req, file, columnar, output, stream, checkpoint_key
+            )
+        if stream:
+            lines = self.compute_stream(req, file, encoding)
+            head = []
+            size = 0
+            # Whether the rest of the file is not read yet.
+            file.head = False
+            for line in lines:
+                head.append(line)
+                size += len(line)
+                if size >= config.CSV_CHUNK_SIZE:
+                    file.head = True
+                    break
+            # Only the head of the file is available for sniffing.
+            file._data = "".join(head)
+            file.lines = itertools.chain(head, lines)
+        else:
+            with req.context.metrics.timer("decode"):
+                file._data = self.compute_content(req, file, encoding)
+            # Keep ends, not to glue lines when a field is multilined.
+            file.lines = file.data.splitlines(keepends=True)
         if not file._data:
             raise falcon.HTTPBadRequest(title="Empty file")
-        dialect = self.compute_dialect(req, file, encoding)
+        with req.context.metrics.timer("sniff"):
+            dialect = self.compute_dialect(req, file, encoding)
         rows = self.compute_rows(req, file, dialect)
         fieldnames, columns = self.compute_fieldnames(req, file, rows)
-        output = self.compute_output(req)
         writer = self.compute_writer(req, output, fieldnames, dialect, encoding)
+        req.context.writer = writer
         filters = self.match_filters(req)
-        self.process_rows(req, writer, rows, filters, columns)
-        output.seek(0)
+        if checkpoint_key:
+            req.context.checkpoint = Checkpoint.open(checkpoint_key, fieldnames)
+        if stream:
+            # Lines count is not known, estimate from the bytes read.
+            total = None
+            if req.get_param("progress_id"):
+                total = self.compute_stream_size(req, file)
+            req.context.progress = self.compute_progress(
+                req, total, lambda: file.consumed
+            )
+        else:
+            req.context.progress = self.compute_progress(req, len(file.lines))
+        return self.process_rows(req, writer, rows, filters, columns)
+
+    def compute_stream_size(self, req, file):
+        if getattr(file, "size", None) is not None:
+            return file.size
+        if getattr(file.stream, "seekable", lambda: False)():
+            position = file.stream.tell()
+            size = file.stream.seek(0, os.SEEK_END)
+            file.stream.seek(position)
+            return size
+        # Whole body of the request, a bit more than the file.
+        return req.content_length
+
+    def compute_progress(self, req, total, position=None):
+        id = req.get_param("progress_id")
+        if not id:
+            return None
+        if not Progress.ID.fullmatch(id):
+            msg = "Invalid progress_id, must be 1 to 64 letters, digits, - or _"
+            raise falcon.HTTPBadRequest(title=msg)
+        return Progress(id, total, position)
+
+    def compute_columnar_format(self, req, file):
+        ext = os.path.splitext(file.filename)[1].lower()
+        format = COLUMNAR_FORMATS.get(ext)
+        if format and pyarrow is None:
+            msg = "Unable to process {} files, pyarrow is not installed".format(ext)
+            raise falcon.HTTPBadRequest(title=msg)
+        if format and req.get_param("format", default=format) != format:
+            msg = "{} files can only be returned as {}".format(ext, format)
+            raise falcon.HTTPBadRequest(title=msg)
+        return format
+
+    def process_columnar(self, req, file, format, output, stream, checkpoint_key):
+        if not stream:
+            source = pyarrow.BufferReader(file.data)
+        elif getattr(file.stream, "seekable", lambda: False)():
+            source = file.stream
+        else:
+            # Columnar files need random access, spool it on disk.
+            source = tempfile.TemporaryFile()
+            shutil.copyfileobj(file.stream, source, config.CSV_CHUNK_SIZE)
+            source.seek(0)
+        try:
+            if format == "parquet":
+                reader = pyarrow.parquet.ParquetFile(source)
+                schema = reader.schema_arrow
+                size = max(config.CSV_BATCH_SIZE, 1)
+                batches = reader.iter_batches(batch_size=size)
+            elif format == "arrow":
+                reader = pyarrow.ipc.open_file(source)
+                schema = reader.schema
+                batches = (
+                    reader.get_batch(i) for i in range(reader.num_record_batches)
+                )
+            else:
+                reader = pyarrow.ipc.open_stream(source)
+                schema = reader.schema
+                batches = reader
+        except pyarrow.ArrowException as e:
+            msg = "Unable to read {} file".format(format)
+            raise falcon.HTTPBadRequest(title=msg, description=str(e))
+        writer = ColumnarWriter(
+            output,
+            format,
+            schema,
+            self.compute_result_headers(req),
+            self.compute_numeric_headers(req),
+        )
+        rows = ColumnarReader(batches, schema, writer)
+        fieldnames, columns = self.compute_fieldnames(req, file, rows)
+        filters = self.match_filters(req)
+        if checkpoint_key:
+            req.context.checkpoint = Checkpoint.open(checkpoint_key, fieldnames)
+        total = reader.metadata.num_rows if format == "parquet" else None
+        req.context.progress = self.compute_progress(req, total)
+        yield from self.process_rows(req, writer, rows, filters, columns)
+        writer.close()
+
+    def on_post(self, req, resp, **kwargs):
+        file = self.parse_multipart(req)
+        if not file:
+            raise falcon.HTTPBadRequest(title="Missing file")
+        if len(req.context.files) > 1 or file.filename.lower().endswith(".zip"):
+            files = self.expand_archives(req.context.files)
+            return self.process_files(req, resp, files)
+        spooled = getattr(file, "spooled", False)
+        stream = config.CSV_STREAM or spooled
+        columnar = self.compute_columnar_format(req, file)
+        if columnar:
+            output = tempfile.TemporaryFile() if spooled else io.BytesIO()
+            for _ in self.process(req, file, None, output, stream):
+                pass
+            if spooled:
+                resp.set_stream(output, output.tell())
+                output.seek(0)
+            else:
+                resp.data = output.getvalue()
+            req.context.metrics.set_headers(resp)
+            report_metrics(self.endpoint, req.context.metrics)
+            set_attachment(resp, file.filename, None, columnar)
+            return
+        encoding = req.get_param("encoding", default=config.CSV_ENCODING)
+        format = self.compute_format(req)
+        output_encoding = self.compute_output_encoding(req, encoding)
+        # Big uploads are geocoded to a temporary file, instead of memory.
+        spool_output = spooled and format == "csv" and not config.CSV_STREAM
+        if spool_output:
+            output = self.compute_spooled_output(req)
+        else:
+            output = self.compute_output(req)
+        processed = self.process(req, file, encoding, output, stream)
         try:
-            resp.text = output.read().encode(encoding)
+            if config.CSV_STREAM or format != "csv":
+                # Send JSON lines as soon as they are ready.
+                size = config.CSV_CHUNK_SIZE if format == "csv" else 0
+                chunks = self.stream_output(req, processed, output, size)
+                # Compute the first chunk now, so errors on first rows still
+                # end in a proper HTTP error.
+                resp.stream = itertools.chain([next(chunks)], chunks)
+            else:
+                for _ in processed:
+                    pass
+                if spool_output:
+                    resp.set_stream(output, output.tell())
+                    output.seek(0)
+                else:
+                    resp.data = output.getvalue()
+                # Headers are already sent when streaming, so only here.
+                resp.set_header("X-Dedup-Hits", str(req.context.dedup.hits))
+                resp.set_header("X-Dedup-Misses", str(req.context.dedup.misses))
+                req.context.metrics.set_headers(resp)
+                report_metrics(self.endpoint, req.context.metrics)
         except UnicodeEncodeError:
             raise falcon.HTTPBadRequest("Wrong encoding", "Wrong encoding")
-        filename, ext = os.path.splitext(file.filename)
-        attachment = 'attachment; filename="{name}.geocoded.csv"'.format(name=filename)
-        resp.set_header("Content-Disposition", attachment)
-        content_type = "text/csv; charset={encoding}".format(encoding=encoding)
-        resp.set_header("Content-Type", content_type)
+        set_attachment(resp, file.filename, output_encoding, format)
 
-    def add_extra_fields(self, row, result):
-        for key in config.CSV_EXTRA_FIELDS:
-            row["result_{}".format(key)] = getattr(result, key, "")
+    def lookup(self, req, key, compute, query, filters):
+        # First look in the request cache, then in the process one.
+        key = (self.endpoint,) + key
+        results = req.context.dedup.get(key)
+        if results is None:
+            results = CACHE.get(key)
+            if results is None:
+                metrics = req.context.metrics
+                results = Throttle.run(
+                    req.context.throttle,
+                    lambda: metrics.engine(compute, query, filters),
+                )
+                CACHE.set(key, results)
+            req.context.dedup.set(key, results)
+        return results
+
+    def add_extra_fields(self, row, result, plan):
+        for key, header in plan.extra_fields:
+            row[header] = getattr(result, key, "")
 
     @property
     def result_headers(self):
@@ -193,41 +1641,206 @@ class BaseCSV(View):
                 headers.append(header)
         return self.base_headers + headers
 
-    def match_row_filters(self, row, filters):
-        return {k: row.get(v, "") for k, v in filters.items()}
+    def compute_result_headers(self, req):
+        return self.result_headers
+
+    def compute_numeric_headers(self, req):
+        return self.numeric_headers
+
+    def match_row_filters(self, row, plan):
+        return {k: row.get(v, "") for k, v in plan.filters}
 
 
 class CSVSearch(BaseCSV):
 
     endpoint = "search.csv"
+    numeric_headers = {
+        "latitude": float,
+        "longitude": float,
+        "result_score": float,
+        "result_score_next": float,
+    }
+    coordinates_headers = ("longitude", "latitude")
 
     @property
     def base_headers(self):
         return config.CSV_HEADERS
 
-    def process_row(self, req, row, filters, columns, index):
+    def compute_candidates(self, req):
+        return req.get_param_as_int(
+            "candidates", default=1, min_value=1, max_value=config.CSV_MAX_CANDIDATES
+        )
+
+    def candidate_header(self, header, rank):
+        return "{}_{}".format(header, rank)
+
+    def compute_incremental(self, req):
+        return req.get_param_as_bool("incremental", default=False)
+
+    def compute_result_headers(self, req):
+        headers = self.result_headers
+        # Next candidates have their own suffixed columns, but no next score.
+        candidate = [h for h in headers if h != "result_score_next"]
+        for rank in range(2, self.compute_candidates(req) + 1):
+            headers += [self.candidate_header(h, rank) for h in candidate]
+        if config.CSV_STATUS_COLUMN:
+            headers.append(config.CSV_STATUS_COLUMN)
+        if self.compute_incremental(req):
+            headers.append(config.CSV_HASH_COLUMN)
+        return headers
+
+    def compute_structure(self, req):
+        """Columns mapped to fields which are not filters, eg. `street=voie`."""
+        fields = ["housenumber"]
+        fields += [f["key"] for f in config.FIELDS if f.get("type") != "housenumbers"]
+        return [
+            (field, req.get_param(field))
+            for field in fields
+            if field not in config.FILTERS and req.get_param(field)
+        ]
+
+    def compute_fieldnames(self, req, file, rows):
+        fieldnames, columns = super().compute_fieldnames(req, file, rows)
+        structure = self.compute_structure(req)
+        if structure:
+            # Structured mode: only the mapped columns (and given columns, if
+            # any) are searched, in fields order, while filters columns are
+            # only used as filters.
+            columns = req.get_param_as_list("columns") or []
+            for field, column in structure:
+                if column not in fieldnames:
+                    msg = "Cannot found column '{}' for field '{}' in columns {}"
+                    msg = msg.format(column, field, fieldnames)
+                    raise falcon.HTTPBadRequest(title=msg)
+                if column not in columns:
+                    columns.append(column)
+            # The housenumber is passed to the engine apart from the query.
+            columns = [c for c in columns if c != dict(structure).get("housenumber")]
+        elif self.compute_incremental(req) and not req.get_param_as_list("columns"):
+            # Results of a previous run are not part of the query.
+            headers = self.compute_result_headers(req)
+            columns = [c for c in columns if c not in headers]
+        return fieldnames, columns
+
+    def compute_numeric_headers(self, req):
+        headers = dict(self.numeric_headers)
+        for rank in range(2, self.compute_candidates(req) + 1):
+            for header, type_ in self.numeric_headers.items():
+                headers[self.candidate_header(header, rank)] = type_
+        return headers
+
+    def compute_plan(self, req, filters, columns):
+        plan = super().compute_plan(req, filters, columns)
+        plan.candidates = self.compute_candidates(req)
+        plan.incremental = self.compute_incremental(req)
+        plan.structure = self.compute_structure(req)
+        if plan.incremental:
+            plan.result_headers = self.compute_result_headers(req)
+        return plan
+
+    def compute_hash(self, q, filters):
+        data = json.dumps([q, sorted(filters.items())]).encode()
+        return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+    def is_up_to_date(self, row, plan, digest):
+        if row.get(config.CSV_HASH_COLUMN) != digest:
+            return False
+        try:
+            return float(row.get("result_score")) > plan.min_score
+        except (TypeError, ValueError):
+            return False
+
+    def compute_query(self, row, columns):
         # We don't want None in a join.
-        q = " ".join([row[k] or "" for k in columns])
-        min_score = req.get_param_as_float("min_score", default=config.CSV_MIN_SCORE)
-        filters = self.match_row_filters(row, filters)
-        lat_column = req.get_param("lat")
-        lon_column = req.get_param("lon")
-        if lon_column and lat_column:
+        return " ".join([row[k] or "" for k in columns])
+
+    def prepare_query(self, q):
+        """Normalize the query, return it with a status if it is not searchable."""
+        q = " ".join(q.split())
+        if not any(char.isalnum() for char in q):
+            return q, "empty"
+        if config.CSV_OVERSIZE == "error":
+            return q, None
+        # The engine checks the length once transliterated, which can be much
+        # longer (eg. for chinese).
+        folded = ascii(q)
+        if len(folded) > config.QUERY_MAX_LENGTH:
+            if config.CSV_OVERSIZE == "skip":
+                return q, "too_long"
+            # Do not cut a word.
+            folded = folded[: config.QUERY_MAX_LENGTH + 1].rsplit(" ", 1)[0]
+            return folded[: config.QUERY_MAX_LENGTH].strip(), "truncated"
+        return q, None
+
+    def prepare_batch(self, req, rows, filters, columns):
+        queries = []
+        for row in rows:
+            q, status = self.prepare_query(self.compute_query(row, columns))
+            if status not in ("empty", "too_long"):
+                queries.append(q)
+        req.context.frequencies = prefetch_frequencies(queries)
+
+    def process_row(self, req, row, filters, columns, index):
+        plan = req.context.plan
+        metrics = req.context.metrics
+        q = self.compute_query(row, plan.columns)
+        filters = self.match_row_filters(row, plan)
+        structure = {field: row.get(column) or "" for field, column in plan.structure}
+        if plan.center:
+            lat_column, lon_column = plan.center
             lat = row.get(lat_column)
             lon = row.get(lon_column)
             if lat and lon:
                 filters["lat"] = float(lat)
                 filters["lon"] = float(lon)
+        if plan.incremental:
+            # Mapped fields are never filters, their names can't clash.
+            digest = self.compute_hash(q, dict(filters, **structure))
+            if self.is_up_to_date(row, plan, digest):
+                metrics.incr("skipped")
+                return
+            # Drop the results of the previous run, which are outdated.
+            for header in plan.result_headers:
+                row[header] = ""
+            row[config.CSV_HASH_COLUMN] = digest
+        q, status = self.prepare_query(q)
+        if config.CSV_STATUS_COLUMN:
+            row[config.CSV_STATUS_COLUMN] = status or "notfound"
+        if status in ("truncated", "too_long"):
+            metrics.incr("oversize")
+        if status in ("empty", "too_long"):
+            if status == "empty":
+                metrics.incr("empty")
+            return
+
+        # At least 3, to get the score of the next result.
+        limit = max(plan.candidates, 3)
+
+        def compute():
+            helper = BatchSearch(
+                req.context.frequencies, autocomplete=False, limit=limit
+            )
+            return helper(q, structure=structure, **filters)
+
+        # Results do not depend on case nor accents.
+        key = (
+            ascii(q),
+            tuple(sorted(filters.items())),
+            tuple(sorted(structure.items())),
+            limit,
+        )
         try:
-            results = search(q, autocomplete=False, limit=3, **filters)
+            results = self.lookup(req, key, compute, q, filters)
         except EntityTooLarge as e:
             msg = "{} (row number {})".format(str(e), index + 1)
             raise falcon.HTTPPayloadTooLarge(title=msg)
         log_query(q, results)
+        if not results or round(results[0].score, 2) <= plan.min_score:
+            metrics.incr("notfound")
         if results:
             result = results[0]
             score = round(result.score, 2)
-            if score > min_score:
+            if score > plan.min_score:
                 row.update(
                     {
                         "latitude": result.lat,
@@ -242,31 +1855,122 @@ class CSVSearch(BaseCSV):
                         "result_housenumber": result.housenumber,
                     }
                 )
-                self.add_extra_fields(row, result)
+                self.add_extra_fields(row, result, plan)
+                metrics.incr("matched")
+                if config.CSV_STATUS_COLUMN and not status:
+                    row[config.CSV_STATUS_COLUMN] = "matched"
+                self.add_candidates(row, results, plan)
         else:
             log_notfound(q)
 
+    def add_candidates(self, row, results, plan):
+        for rank, result in enumerate(results[1 : plan.candidates], 2):
+            score = round(result.score, 2)
+            if score <= plan.min_score:
+                break
+            candidate = {
+                "latitude": result.lat,
+                "longitude": result.lon,
+                "result_label": str(result),
+                "result_score": score,
+                "result_type": result.type,
+                "result_id": result.id,
+                "result_housenumber": result.housenumber,
+            }
+            for key, header in plan.extra_fields:
+                candidate[header] = getattr(result, key, "")
+            for header, value in candidate.items():
+                row[self.candidate_header(header, rank)] = value
+
 
 class CSVReverse(BaseCSV):
 
     endpoint = "reverse.csv"
+    numeric_headers = {
+        "result_latitude": float,
+        "result_longitude": float,
+        "result_distance": int,
+    }
+    coordinates_headers = ("result_longitude", "result_latitude")
 
     @property
     def base_headers(self):
         return config.CSV_REVERSE_HEADERS
 
-    def process_row(self, req, row, filters, columns, index):
-        lat = row.get("latitude", row.get("lat", None))
-        lon = row.get(
-            "longitude", row.get("lon", row.get("lng", row.get("long", None)))
-        )
+    LAT_COLUMNS = ("latitude", "lat")
+    LON_COLUMNS = ("longitude", "lon", "lng", "long")
+
+    def prepare_batch(self, req, rows, filters, columns):
+        plan = req.context.plan
+        if not plan.resolved:
+            # Columns are the same for every row, resolve them once.
+            plan.resolve(rows[0], lat_key=self.LAT_COLUMNS, lon_key=self.LON_COLUMNS)
+        if not config.CSV_REVERSE_GROUPING:
+            return
+        lat_key = plan.lat_key
+        lon_key = plan.lon_key
+        indexes = array("L")
+        lats = array("d")
+        lons = array("d")
+        for i, row in enumerate(rows):
+            try:
+                lat = float(row.get(lat_key))
+                lon = float(row.get(lon_key))
+            except (ValueError, TypeError):
+                continue
+            indexes.append(i)
+            lats.append(lat)
+            lons.append(lon)
+        cells = defaultdict(list)
+        for i, lat, lon in zip(indexes, lats, lons):
+            row_filters = self.match_row_filters(rows[i], plan)
+            geoh = geohash.encode(lat, lon, config.GEOHASH_PRECISION)
+            cells[(geoh, tuple(sorted(row_filters.items())))].append((i, lat, lon))
+        # Rows are identified by id, as long as the batch is being processed.
+        req.context.reversed = {}
+        metrics = req.context.metrics
+        for (geoh, row_filters), points in cells.items():
+            row_filters = dict(row_filters)
+            helper = Throttle.run(
+                req.context.throttle,
+                lambda: metrics.engine(
+                    lambda: CellReverse(geoh, limit=1, **row_filters),
+                    "cell {}".format(geoh),
+                    row_filters,
+                ),
+            )
+            for i, lat, lon in points:
+                req.context.reversed[id(rows[i])] = helper(lat, lon)
+
+    def reverse_row(self, req, row):
+        if config.CSV_REVERSE_GROUPING:
+            return req.context.reversed.get(id(row))
+        plan = req.context.plan
         try:
-            lat = float(lat)
-            lon = float(lon)
+            lat = float(row.get(plan.lat_key))
+            lon = float(row.get(plan.lon_key))
         except (ValueError, TypeError):
-            return
-        filters = self.match_row_filters(row, filters)
-        results = reverse(lat=lat, lon=lon, limit=1, **filters)
+            return None
+        filters = self.match_row_filters(row, plan)
+        # Round to about ten centimeters, not to change the computed distance.
+        key = (round(lat, 6), round(lon, 6), tuple(sorted(filters.items())))
+        return self.lookup(
+            req,
+            key,
+            lambda: reverse(lat=lat, lon=lon, limit=1, **filters),
+            "{} {}".format(lat, lon),
+            filters,
+        )
+
+    def process_row(self, req, row, filters, columns, index):
+        results = self.reverse_row(req, row)
+        # None when coordinates are missing or invalid.
+        if results is None:
+            req.context.metrics.incr("empty")
+        elif not results:
+            req.context.metrics.incr("notfound")
+        else:
+            req.context.metrics.incr("matched")
         if results:
             result = results[0]
             row.update(
@@ -280,4 +1984,341 @@ class CSVReverse(BaseCSV):
                     "result_housenumber": result.housenumber,
                 }
             )
-            self.add_extra_fields(row, result)
+            self.add_extra_fields(row, result, req.context.plan)
+
+
+def replay_request(params, client="127.0.0.1"):
+    # Replay form parameters through a Falcon request, so views can use it as
+    # usual.
+    environ = {
+        "REQUEST_METHOD": "POST",
+        "PATH_INFO": "/",
+        "QUERY_STRING": "",
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "80",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "REMOTE_ADDR": client,
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": None,
+    }
+    req = falcon.Request(environ)
+    req._params = params
+    return req
+
+
+class JobFile:
+    """Mimic a multipart body part, for an upload stored on disk or zipped."""
+
+    def __init__(self, stream, filename, size=None):
+        self.stream = stream
+        self.filename = filename
+        self.size = size
+        self._data = None
+
+    @property
+    def data(self):
+        return self._data
+
+
+jobs_logger = logging.getLogger("csv_jobs")
+
+
+class Job:
+    """A CSV file geocoded in the background, with its state stored on disk."""
+
+    ID = re.compile(r"[0-9a-f]{32}")
+    executor = None
+    lock = threading.Lock()
+    # Jobs pending or running in this process.
+    owned = set()
+
+    def __init__(self, id):
+        self.id = id
+        self.path = Path(config.CSV_JOBS_DIR) / id
+        self.input = self.path / "input"
+        self.output = self.path / "output"
+
+    @classmethod
+    def create(cls):
+        job = cls(uuid.uuid4().hex)
+        job.path.mkdir(parents=True)
+        return job
+
+    @classmethod
+    def get(cls, id):
+        if not cls.ID.fullmatch(id):
+            raise falcon.HTTPNotFound(title="Unknown job")
+        job = cls(id)
+        if not job.path.joinpath("status.json").exists():
+            raise falcon.HTTPNotFound(title="Unknown job")
+        return job
+
+    @classmethod
+    def submit(cls, job, view):
+        # Create the pool lazily, not to start threads before workers fork.
+        with cls.lock:
+            if cls.executor is None:
+                cls.executor = ThreadPoolExecutor(config.CSV_JOBS_WORKERS)
+                threading.Thread(target=cls.beat, daemon=True).start()
+            cls.owned.add(job)
+        job.touch()
+        cls.executor.submit(job.run, view)
+
+    @classmethod
+    def beat(cls):
+        """Tell readers that the jobs of this process are still alive."""
+        while True:
+            time.sleep(config.CSV_JOBS_HEARTBEAT)
+            with cls.lock:
+                jobs = list(cls.owned)
+            for job in jobs:
+                job.touch()
+
+    @classmethod
+    def clean(cls):
+        """Remove jobs finished more than CSV_JOBS_TTL seconds ago."""
+        root = Path(config.CSV_JOBS_DIR)
+        if not config.CSV_JOBS_TTL or not root.is_dir():
+            return
+        for path in root.iterdir():
+            if not cls.ID.fullmatch(path.name):
+                continue
+            job = cls(path.name)
+            try:
+                status = job.status["status"]
+                age = time.time() - job.path.joinpath("status.json").stat().st_mtime
+            except (OSError, ValueError):
+                # Being created, or removed by another process.
+                continue
+            if status in ("done", "failed") and age > config.CSV_JOBS_TTL:
+                shutil.rmtree(job.path, ignore_errors=True)
+
+    def touch(self):
+        try:
+            self.path.joinpath("heartbeat").touch()
+        except FileNotFoundError:
+            pass
+
+    @property
+    def stale(self):
+        beats = []
+        for name in ("heartbeat", "status.json"):
+            try:
+                beats.append(self.path.joinpath(name).stat().st_mtime)
+            except FileNotFoundError:
+                pass
+        return time.time() - max(beats) > 3 * config.CSV_JOBS_HEARTBEAT
+
+    def read(self, name):
+        with self.path.joinpath(name).open() as f:
+            return json.load(f)
+
+    def write(self, name, data):
+        # Write then rename, so a reader never sees a partial file.
+        tmp = self.path.joinpath(name + ".tmp")
+        with tmp.open("w") as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path.joinpath(name))
+
+    @property
+    def status(self):
+        status = self.read("status.json")
+        if status["status"] in ("pending", "running") and self.stale:
+            # The process running it is gone (restart, crash…).
+            status.update(status="failed", error="Interrupted")
+            self.write("status.json", status)
+        return status
+
+    @property
+    def params(self):
+        return self.read("params.json")
+
+    def set_status(self, status, **data):
+        data.update({"id": self.id, "status": status, "pid": os.getpid()})
+        self.write("status.json", data)
+
+    def progress(self, rows, consumed, size, start):
+        return compute_progress(rows, consumed / size if size else 1, start)
+
+    def run(self, view):
+        params = self.params
+        # Throttled as the client who submitted the job.
+        req = replay_request(params["form"], params.get("client", "127.0.0.1"))
+        encoding = req.get_param("encoding", default=config.CSV_ENCODING)
+        size = self.input.stat().st_size
+        start = last = time.monotonic()
+        rows = 0
+        self.set_status("running", **self.progress(rows, 0, size, start))
+        tmp = self.path / "output.tmp"
+        try:
+            with self.input.open("rb") as stream:
+                file = JobFile(stream, params["filename"])
+                with tmp.open("wb") as output:
+                    processed = view.process(req, file, encoding, output, stream=True)
+                    for rows, _ in enumerate(processed, 1):
+                        if time.monotonic() - last >= 1:
+                            last = time.monotonic()
+                            progress = self.progress(rows, stream.tell(), size, start)
+                            self.set_status("running", **progress)
+            os.replace(tmp, self.output)
+        except falcon.HTTPError as e:
+            self.set_status("failed", rows=rows, error=e.title)
+        except (LookupError, UnicodeError):
+            self.set_status("failed", rows=rows, error="Wrong encoding")
+        except Exception as e:
+            jobs_logger.exception("Job %s failed", self.id)
+            self.set_status("failed", rows=rows, error=str(e))
+        else:
+            metrics = req.context.metrics
+            report_metrics(view.endpoint, metrics)
+            progress = self.progress(rows, size, size, start)
+            self.set_status("done", **progress, **metrics.as_dict())
+        finally:
+            with self.lock:
+                self.owned.discard(self)
+
+
+class CSVJobs(View):
+    """Submit a CSV file to be geocoded in the background by `view`."""
+
+    def __init__(self, view):
+        self.view = view
+
+    def on_post(self, req, resp, **kwargs):
+        Job.clean()
+        job = Job.create()
+        form = defaultdict(list)
+        filename = None
+        try:
+            for part in req.get_media():
+                if part.name == "data" and not filename:
+                    filename = part.filename
+                    # Copy by chunks, not to load the whole file in memory.
+                    with job.input.open("wb") as f:
+                        shutil.copyfileobj(part.stream, f, config.CSV_CHUNK_SIZE)
+                else:
+                    form[part.name].append(part.text)
+            if not filename:
+                raise falcon.HTTPBadRequest(title="Missing file")
+            params = {"filename": filename, "form": form, "client": req.remote_addr}
+            job.write("params.json", params)
+            job.set_status("pending", rows=0)
+        except BaseException:
+            # Client gone, invalid multipart…: a job without status would
+            # never be cleaned.
+            shutil.rmtree(job.path, ignore_errors=True)
+            raise
+        Job.submit(job, self.view)
+        resp.status = falcon.HTTP_202
+        resp.set_header("Location", "/csv/jobs/{}".format(job.id))
+        resp.media = {"id": job.id, "status": "pending"}
+
+
+class CSVJob(View):
+    def on_get(self, req, resp, job_id, **kwargs):
+        resp.media = Job.get(job_id).status
+
+
+class CSVJobResult(View):
+    def on_get(self, req, resp, job_id, **kwargs):
+        job = Job.get(job_id)
+        if job.status["status"] != "done":
+            raise falcon.HTTPConflict(title="Job is not done")
+        params = job.params
+        encoding = params["form"].get("encoding", [config.CSV_ENCODING])[-1]
+        format = params["form"].get("format", ["csv"])[-1]
+        ext = os.path.splitext(params["filename"])[1].lower()
+        format = COLUMNAR_FORMATS.get(ext, format)
+        if format != "csv":
+            encoding = "utf-8"
+        resp.stream = job.output.open("rb")
+        resp.content_length = job.output.stat().st_size
+        set_attachment(resp, params["filename"], encoding, format)
+
+
+class CSVMetrics(View):
+    """Totals of the processed files, in the Prometheus text format.
+
+    Totals are kept by process: each worker exposes its own.
+    """
+
+    def on_get(self, req, resp, **kwargs):
+        lines = [
+            "# HELP addok_csv_requests_total Files processed.",
+            "# TYPE addok_csv_requests_total counter",
+        ]
+        for endpoint, metrics in METRICS.items():
+            lines.append(
+                'addok_csv_requests_total{{endpoint="{}"}} {}'.format(
+                    endpoint, metrics.requests
+                )
+            )
+        for counter, help in Metrics.COUNTERS.items():
+            name = "addok_csv_{}_total".format(
+                counter if counter == "rows" else counter + "_rows"
+            )
+            lines.append("# HELP {} {}.".format(name, help))
+            lines.append("# TYPE {} counter".format(name))
+            for endpoint, metrics in METRICS.items():
+                lines.append(
+                    '{}{{endpoint="{}"}} {}'.format(
+                        name, endpoint, metrics.counters[counter]
+                    )
+                )
+        lines.append(
+            "# HELP addok_csv_stage_seconds_total Time spent in each processing stage."
+        )
+        lines.append("# TYPE addok_csv_stage_seconds_total counter")
+        for endpoint, metrics in METRICS.items():
+            for stage, duration in metrics.timings.items():
+                lines.append(
+                    'addok_csv_stage_seconds_total{{endpoint="{}",stage="{}"}} {}'.format(
+                        endpoint, stage, duration
+                    )
+                )
+        if WARMUP:
+            lines.append(
+                "# HELP addok_csv_warmup_seconds Duration of each step of the warmup."
+            )
+            lines.append("# TYPE addok_csv_warmup_seconds gauge")
+            for step, duration in WARMUP.items():
+                lines.append(
+                    'addok_csv_warmup_seconds{{step="{}"}} {}'.format(step, duration)
+                )
+        resp.text = "\n".join(lines) + "\n"
+        resp.content_type = "text/plain; version=0.0.4"
+
+
+class CSVProgress(View):
+    """Progress of a file sent with a `progress_id`, while it is processed.
+
+    As JSON, or as server-sent events until the end of the processing when
+    asked for `text/event-stream`.
+    """
+
+    def on_get(self, req, resp, progress_id, **kwargs):
+        data = Progress.load(progress_id)
+        if data is None:
+            raise falcon.HTTPNotFound(title="Unknown progress_id")
+        if req.client_accepts("text/event-stream") and not req.client_accepts_json:
+            resp.content_type = "text/event-stream"
+            resp.stream = self.events(progress_id, data)
+        else:
+            resp.media = data
+
+    def events(self, progress_id, data):
+        changed = time.monotonic()
+        while True:
+            yield "data: {}\n\n".format(json.dumps(data)).encode()
+            if data["status"] != "running":
+                break
+            # Do not hold the worker forever if the processing died.
+            if time.monotonic() - changed > config.CSV_PROGRESS_STALL:
+                break
+            time.sleep(config.CSV_PROGRESS_INTERVAL)
+            previous, data = data, Progress.load(progress_id)
+            if data is None:
+                break
+            if data != previous:
+                changed = time.monotonic()
@@ -0,0 +1,243 @@
+"""Benchmark the CSV endpoints on synthetic files.
+
+Index a fake dataset, then geocode generated CSV files through the HTTP
+application and report throughput, peak memory of the process and the time
+spent in each stage of the processing, as reported by the `Server-Timing`
+header of the responses. For example:
+
+    python benchmarks/csv_endpoints.py --rows 100000 --duplicates 0.3
+    python benchmarks/csv_endpoints.py --reverse --rows 10000 --repeat 5
+    python benchmarks/csv_endpoints.py --set CSV_WORKERS=4 --set CSV_STREAM=True
+
+It uses the same config and Redis databases as the test suite (14 and 15),
+which are flushed at the end of the run.
+"""
+
+import argparse
+import ast
+import csv
+import io
+import random
+import resource
+import statistics
+import time
+from collections import defaultdict, deque
+
+KINDS = ["rue", "avenue", "boulevard", "allée", "impasse", "chemin", "place"]
+WORDS = [
+    "des avions",
+    "de la gare",
+    "du moulin",
+    "des lilas",
+    "de l'église",
+    "du château",
+    "des écoles",
+    "de la mairie",
+    "du stade",
+    "des peupliers",
+    "de la fontaine",
+    "du port",
+]
+CITIES = [
+    ("31310", "Montbrun-Bocage"),
+    ("09350", "Fornex"),
+    ("75018", "Paris"),
+    ("59118", "Wambrechies"),
+    ("80688", "Amiens"),
+    ("35000", "Rennes"),
+]
+
+
+def setup():
+    from addok import hooks
+    from addok import pytest as addok_pytest
+
+    import addok_csv
+
+    hooks.register(addok_csv)
+    addok_pytest.pytest_configure()
+
+
+def teardown():
+    from addok import pytest as addok_pytest
+
+    addok_pytest.pytest_runtest_teardown(None, None)
+
+
+def index(count, rng):
+    from addok.db import DB
+    from addok.pytest import DummyDoc
+
+    docs = []
+    for i in range(count):
+        postcode, city = rng.choice(CITIES)
+        doc = DummyDoc(
+            id="bench{}".format(i),
+            _id=DB.next_id(),
+            type="street",
+            name="{} {}".format(rng.choice(KINDS), rng.choice(WORDS)),
+            importance=rng.random(),
+            postcode=postcode,
+            city=city,
+            lat=round(rng.uniform(43, 50), 6),
+            lon=round(rng.uniform(-1, 7), 6),
+        )
+        docs.append(doc)
+    return docs
+
+
+def generate(docs, args, rng):
+    """Return the CSV file content, as bytes in the wanted encoding."""
+    if args.reverse:
+        header = ["latitude", "longitude"]
+    else:
+        header = ["adresse", "code postal", "ville"]
+    header += ["col{}".format(i) for i in range(len(header), args.columns)]
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(header)
+    seen = deque(maxlen=1000)
+    for i in range(args.rows):
+        if seen and rng.random() < args.duplicates:
+            writer.writerow(rng.choice(seen))
+            continue
+        doc = rng.choice(docs)
+        if args.reverse:
+            row = [
+                round(doc["lat"] + rng.uniform(-0.001, 0.001), 6),
+                round(doc["lon"] + rng.uniform(-0.001, 0.001), 6),
+            ]
+        else:
+            name = doc["name"]
+            if rng.random() < args.multiline:
+                name = "{}\nbâtiment {}".format(name, rng.randint(1, 9))
+            row = [name, doc["postcode"], doc["city"]]
+        row += ["value {}".format(i)] * (len(header) - len(row))
+        seen.append(row)
+        writer.writerow(row)
+    return output.getvalue().encode(args.encoding, errors="replace")
+
+
+def parse_timings(header):
+    """Return the durations, in seconds, of a `Server-Timing` header."""
+    timings = {}
+    for entry in filter(None, (e.strip() for e in header.split(","))):
+        stage, _, duration = entry.partition(";dur=")
+        timings[stage] = float(duration) / 1000
+    return timings
+
+
+def percentile(values, ratio):
+    values = sorted(values)
+    return values[min(int(len(values) * ratio), len(values) - 1)]
+
+
+def peak_rss():
+    # Kilobytes on Linux, for the whole process since it started.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def report(timings, durations, rows, size, rss):
+    total = sum(durations)
+    print(
+        "{} rows, {:.1f} MB, {} run(s): {:.0f} rows/s".format(
+            rows, size / 1024 / 1024, len(durations), rows * len(durations) / total
+        )
+    )
+    print(
+        "process peak RSS: {:.0f} MB ({:.0f} MB before the requests)".format(
+            peak_rss(), rss
+        )
+    )
+    if not timings:
+        # Headers are sent before the rows are processed.
+        print("no Server-Timing header: streamed responses are not timed")
+        return
+    line = "{:<10} {:>10} {:>12} {:>12} {:>12}"
+    print(line.format("stage", "total s", "p50 ms", "p90 ms", "p99 ms"))
+    stages = defaultdict(list)
+    for timing, duration in zip(timings, durations):
+        for stage, value in timing.items():
+            stages[stage].append(value)
+        # Eg. multipart parsing, not measured by the endpoint.
+        stages["other"].append(duration - sum(timing.values()))
+    stages["request"] = durations
+    for stage, values in stages.items():
+        print(
+            line.format(
+                stage,
+                "{:.3f}".format(sum(values)),
+                "{:.3f}".format(percentile(values, 0.5) * 1000),
+                "{:.3f}".format(percentile(values, 0.9) * 1000),
+                "{:.3f}".format(percentile(values, 0.99) * 1000),
+            )
+        )
+    if len(durations) > 1:
+        print("request stdev: {:.3f} s".format(statistics.stdev(durations)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--columns", type=int, default=3, help="total columns")
+    parser.add_argument("--encoding", default="utf-8")
+    parser.add_argument(
+        "--duplicates", type=float, default=0.0, help="ratio of repeated rows"
+    )
+    parser.add_argument(
+        "--multiline", type=float, default=0.0, help="ratio of multiline fields"
+    )
+    parser.add_argument("--docs", type=int, default=1000, help="indexed streets")
+    parser.add_argument("--reverse", action="store_true")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="override a config value, eg. CSV_WORKERS=4",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    setup()
+    from addok.config import config
+    from addok.http.wsgi import application
+    from pytest_falcon.plugin import Client
+
+    for item in args.set:
+        key, value = item.split("=", 1)
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        setattr(config, key, value)
+    rng = random.Random(args.seed)
+    client = Client(application)
+    try:
+        docs = index(args.docs, rng)
+        content = generate(docs, args, rng)
+        path = "/reverse/csv/" if args.reverse else "/search/csv/"
+        form = {"encoding": args.encoding}
+        if not args.reverse:
+            form.update(columns=["adresse", "code postal", "ville"])
+        rss = peak_rss()
+        durations = []
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            resp = client.post(path, data=form, files={"data": (content, "bench.csv")})
+            durations.append(time.perf_counter() - start)
+            assert resp.status_code == 200, resp.body
+            if "server-timing" in resp.headers:
+                timings.append(parse_timings(resp.headers["server-timing"]))
+        report(timings, durations, args.rows, len(content), rss)
+    finally:
+        teardown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,14 @@
+import csv
+import io
+import json
+import os
+import time
+import zipfile
+
 import falcon
+import pytest
+
+import addok_csv
 
 
 def test_csv_endpoint(client, factory):
@@ -156,6 +166,18 @@ def test_csv_endpoint_with_not_enough_content(client, factory):
     assert "80688" in resp.body
 
 
+def test_csv_endpoint_sniffs_only_the_head_of_the_file(client, factory, config):
+    config.CSV_SNIFF_SIZE = 20
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    factory(name="rue des bateaux", postcode="31310", city="Montbrun-Bocage")
+    # One column file, with a semicolon after the sample.
+    content = "adresse\n" "rue des avions\n" "rue des bateaux; 31310\n"
+    resp = client.post("/search/csv/", files={"data": (content, "file.csv")})
+    assert resp.status == falcon.HTTP_200
+    assert resp.body.startswith("\ufeffadresse,latitude,longitude")
+    assert "rue des bateaux; 31310,48.3254,2.256" in resp.body
+
+
 def test_csv_endpoint_with_not_enough_content_but_delimiter(client, factory):
     factory(name="rue", postcode="80688", type="city")
     resp = client.post(
@@ -187,6 +209,15 @@ def test_csv_reverse_endpoint(client, factory):
     assert "rue des brûlés" in resp.body
 
 
+def test_csv_reverse_endpoint_with_short_column_names(client, factory):
+    factory(name="rue des brûlés", lat=10.22334401, lon=12.33445501)
+    content = "lat,lng\n" "10.223344,12.334455\n" ",12.334455\n"
+    resp = client.post("/reverse/csv/", files={"data": (content, "file.csv")})
+    assert resp.status == falcon.HTTP_200
+    assert resp.body.count("rue des brûlés") == 2  # Label and name.
+    assert "\r\n,12.334455,,,,," in resp.body
+
+
 def test_csv_endpoint_can_be_filtered(client, factory):
     factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
     factory(name="rue des avions", postcode="09350", city="Fornex")
@@ -211,6 +242,76 @@ def test_csv_endpoint_can_be_filtered(client, factory):
     assert resp.body.count("31310") == 0
 
 
+def test_csv_endpoint_can_map_columns_to_fields(client, factory):
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    factory(name="rue des avions", postcode="09350", city="Fornex")
+    content = (
+        "voie,cp,ville,note\n"
+        "rue des avions,09350,Fornex,rue des avions Montbrun-Bocage\n"
+        "rue des avions,31310,Montbrun-Bocage,xxx\n"
+    )
+    resp = client.post(
+        "/search/csv/",
+        files={"data": (content, "file.csv")},
+        data={"street": "voie", "city": "ville", "postcode": "cp"},
+    )
+    assert resp.status == falcon.HTTP_200
+    rows = resp.body.splitlines()
+    # Postcode is a filter, and the note column is not searched.
+    assert "Fornex" in rows[1].split(",", 4)[4]
+    assert rows[1].count("09350") == 3
+    assert rows[2].count("31310") == 3
+
+
+def test_csv_endpoint_passes_mapped_housenumber_apart(client, factory):
+    factory(
+        name="rue des avions",
+        postcode="31310",
+        city="Montbrun-Bocage",
+        housenumbers={"12 bis": {"lat": 10.22334401, "lon": 12.33445501}},
+    )
+    content = "numero,voie,ville\n12 bis,rue des avions,Montbrun-Bocage\n"
+    files = {"data": (content, "file.csv")}
+    data = {"housenumber": "numero", "street": "voie", "city": "ville"}
+    resp = client.post("/search/csv/", files=files, data=data)
+    assert resp.status == falcon.HTTP_200
+    row = next(csv.DictReader(io.StringIO(resp.body)))
+    # Matched as a whole, while "bis" is just a word of the query otherwise.
+    assert row["result_housenumber"] == "12 bis"
+    assert row["result_type"] == "housenumber"
+    resp = client.post(
+        "/search/csv/", files=files, data={"columns": ["numero", "voie", "ville"]}
+    )
+    row = next(csv.DictReader(io.StringIO(resp.body)))
+    assert row["result_housenumber"] == ""
+
+
+def test_csv_endpoint_compares_mapped_fields_to_results(client, factory):
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    content = (
+        "voie,ville\n" "rue des avions,Montbrun-Bocage\n" "rue des avions,Fornex\n"
+    )
+    files = {"data": (content, "file.csv")}
+    resp = client.post("/search/csv/", files=files, data={"columns": ["voie", "ville"]})
+    plain = [r["result_score"] for r in csv.DictReader(io.StringIO(resp.body))]
+    data = {"street": "voie", "city": "ville"}
+    resp = client.post("/search/csv/", files=files, data=data)
+    scores = [r["result_score"] for r in csv.DictReader(io.StringIO(resp.body))]
+    # Matching city raises the score, a different one lowers it.
+    assert float(scores[0]) > float(plain[0])
+    assert plain[1] and not scores[1]
+
+
+def test_csv_endpoint_with_unknown_mapped_column(client, factory):
+    content = "voie,cp\nrue des avions,31310"
+    resp = client.post(
+        "/search/csv/",
+        files={"data": (content, "file.csv")},
+        data={"street": "rue"},
+    )
+    assert resp.status == falcon.HTTP_400
+
+
 def test_csv_endpoint_skip_empty_filter_value(client, factory):
     factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
     content = "rue,code postal,ville\n" "rue des avions,,Montbrun-Bocage"
@@ -284,6 +385,50 @@ def test_csv_reverse_endpoint_can_be_filtered(client, factory):
     assert resp.body.count("118") == 2
 
 
+def test_csv_endpoint_with_candidates(client, factory):
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    factory(name="rue des avions", postcode="09350", city="Fornex")
+    content = "adresse\n" "rue des avions\n"
+    files = {"data": (content, "file.csv")}
+    resp = client.post(
+        "/search/csv/", files=files, data={"candidates": "3", "format": "ndjson"}
+    )
+    assert resp.status == falcon.HTTP_200
+    row = json.loads(resp.body)
+    cities = {row["result_city"], row["result_city_2"]}
+    assert cities == {"Montbrun-Bocage", "Fornex"}
+    assert row["result_score_2"] == row["result_score_next"]
+    assert isinstance(row["latitude_2"], float)
+    # Only two results.
+    assert row["result_label_3"] is None
+    assert "result_score_next_2" not in row
+    resp = client.post("/search/csv/", files=files, data={"candidates": "0"})
+    assert resp.status == falcon.HTTP_400
+
+
+def test_csv_endpoint_in_incremental_mode(client, factory):
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    factory(name="rue des bateaux", postcode="09350", city="Fornex")
+    content = "adresse\n" "rue des avions\n" "rue des bateaux\n" "rue\n"
+    form = {"incremental": "true", "delimiter": ","}
+    resp = client.post("/search/csv/", files={"data": (content, "file.csv")}, data=form)
+    assert resp.status == falcon.HTTP_200
+    assert resp.headers["X-Rows-Skipped"] == "0"
+    assert ",result_hash\r\n" in resp.body
+    # Edit a row of the geocoded file, and add a new one.
+    content = resp.body.replace("rue des bateaux", "rue des avions")
+    content += "rue des bateaux\r\n"
+    resp = client.post("/search/csv/", files={"data": (content, "file.csv")}, data=form)
+    assert resp.status == falcon.HTTP_200
+    assert resp.headers["X-Rows-Skipped"] == "1"
+    assert resp.headers["X-Rows-Matched"] == "2"
+    lines = resp.body.splitlines()
+    assert "Fornex" not in lines[2]
+    assert "Montbrun-Bocage" in lines[2]
+    assert "Fornex" in lines[4]
+    assert lines[2].split(",")[-1] != lines[4].split(",")[-1]
+
+
 def test_csv_endpoint_with_pipe_as_quote(client, factory):
     factory(name="rue", postcode="80688", type="city")
     content = "q\n" "|rue|"
@@ -348,3 +493,1102 @@ def test_can_control_min_score(client, factory, config):
     form = {"columns": ["street", "postcode", "city"], "min_score": "0.1"}
     resp = client.post("/search/csv", data=form, files=files)
     assert "rue des avions qui volent avec des ailes" in resp.body
+
+
+def test_csv_endpoint_in_stream_mode(client, factory, config):
+    config.CSV_STREAM = True
+    config.CSV_CHUNK_SIZE = 16  # Force several chunks.
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    content = (
+        "name,adresse\r\n"
+        '"Boulangerie Brûlé","rue des avions\n31310\nMontbrun-Bocage"\n'
+        '"Pâtisserie Crème","rue des avions\r\n31310\r\nMontbrun-Bocage"\n'
+    )
+    resp = client.post(
+        "/search/csv",
+        files={"data": (content, "file.csv")},
+        data={"columns": ["adresse"]},
+    )
+    assert resp.status == falcon.HTTP_200
+    assert "file.geocoded.csv" in resp.headers["Content-Disposition"]
+    assert resp.body.startswith("\ufeffname,adresse,latitude,longitude")
+    assert resp.body.count("rue des avions\r\n31310\r\nMontbrun-Bocage") == 2
+    assert resp.body.count("rue des avions 31310 Montbrun-Bocage") == 2
+    assert "Boulangerie Brûlé" in resp.body
+    assert "Pâtisserie Crème" in resp.body
+
+
+def test_csv_endpoint_in_stream_mode_with_invalid_encoding(client, config):
+    config.CSV_STREAM = True
+    content = "name,street\nBoulangerie Brûlé,rue des avions"
+    files = {"data": (content, "file.csv")}
+    form = {"encoding": "ascii"}
+    resp = client.post("/search/csv", data=form, files=files)
+    assert resp.status == falcon.HTTP_400
+
+
+def test_csv_endpoint_with_unencodable_result(client, factory, config):
+    factory(name="rue des avions", postcode="31310", city="Montbrûn")
+    files = {"data": ("adresse\nrue des avions\n", "file.csv")}
+    form = {"encoding": "ascii"}
+    resp = client.post("/search/csv", data=form, files=files)
+    assert resp.status == falcon.HTTP_400
+    config.CSV_ENCODING_ERRORS = "replace"
+    resp = client.post("/search/csv", data=form, files=files)
+    assert resp.status == falcon.HTTP_200
+    assert "Montbr?n" in resp.body
+
+
+def test_csv_endpoint_in_stream_mode_with_one_column(client, factory, config):
+    config.CSV_STREAM = True
+    config.CSV_CHUNK_SIZE = 64
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    # A delimiter candidate after the head, which is all that can be sniffed.
+    content = "adresse\n" + "rue des avions\n" * 20 + "rue des avions; 31310\n"
+    files = {"data": (content, "file.csv")}
+    resp = client.post("/search/csv", files=files)
+    assert resp.status == falcon.HTTP_400
+    resp = client.post("/search/csv", files=files, data={"delimiter": ","})
+    assert resp.status == falcon.HTTP_200
+    assert "rue des avions; 31310," in resp.body
+    # Whole file in the head.
+    files = {"data": ("adresse\nrue des avions\n", "file.csv")}
+    resp = client.post("/search/csv", files=files)
+    assert resp.status == falcon.HTTP_200
+
+
+def test_csv_endpoint_in_stream_mode_with_empty_file(client, config):
+    config.CSV_STREAM = True
+    resp = client.post("/search/csv", files={"data": ("", "file.csv")})
+    assert resp.status == falcon.HTTP_400
+
+
+def test_csv_endpoint_spools_big_files(client, factory, config):
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    content = (
+        "name,adresse\r\n"
+        '"Boulangerie Brûlé","rue des avions\n31310\nMontbrun-Bocage"\n'
+        '"Pâtisserie Crème","rue des avions 31310 Montbrun-Bocage"\n'
+    )
+    files = {"data": (content, "file.csv")}
+    form = {"columns": ["adresse"]}
+    expected = client.post("/search/csv", files=files, data=form)
+    config.CSV_SPOOL_SIZE = 32
+    resp = client.post("/search/csv", files=files, data=form)
+    assert resp.status == falcon.HTTP_200
+    assert resp.body == expected.body
+    assert resp.headers["Content-Length"] == str(len(resp.body.encode()))
+    assert resp.headers["X-Rows-Matched"] == "2"
+    # Small files stay in memory.
+    config.CSV_SPOOL_SIZE = len(content.encode())
+    resp = client.post("/search/csv", files=files, data=form)
+    assert resp.body == expected.body
+    config.CSV_SPOOL_SIZE = 32
+    resp = client.post("/search/csv", files=files, data={"encoding": "ascii"})
+    assert resp.status == falcon.HTTP_400
+    # One column file, with a delimiter candidate after the sniffed head.
+    content = "adresse\n" + "rue des avions\n" * 20 + "rue des avions; 31310\n"
+    files = {"data": (content, "file.csv")}
+    config.CSV_SPOOL_SIZE = 0
+    expected = client.post("/search/csv", files=files)
+    config.CSV_SPOOL_SIZE = 32
+    config.CSV_CHUNK_SIZE = 64
+    resp = client.post("/search/csv", files=files)
+    assert resp.status == falcon.HTTP_200
+    assert resp.body == expected.body
+    assert "rue des avions; 31310," in resp.body
+
+
+def test_csv_endpoint_with_several_files(client, factory):
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    first = io.BytesIO("adresse\nrue des avions\n".encode())
+    first.name = "north.csv"
+    second = io.BytesIO("rue;ville\nrue des avions;Montbrun\n".encode("latin-1"))
+    second.name = "south.csv"
+    resp = client.post(
+        "/search/csv",
+        data={"data": [first, second], "encoding": "latin-1"},
+        content_type="multipart/form-data",
+    )
+    assert resp.status == falcon.HTTP_200
+    assert resp.headers["Content-Type"] == "application/zip"
+    assert "files.geocoded.zip" in resp.headers["Content-Disposition"]
+    assert resp.headers["X-Rows-Matched"] == "2"
+    with zipfile.ZipFile(io.BytesIO(resp.body)) as archive:
+        assert archive.namelist() == ["north.geocoded.csv", "south.geocoded.csv"]
+        north = archive.read("north.geocoded.csv").decode("latin-1")
+        south = archive.read("south.geocoded.csv").decode("latin-1")
+    assert north.startswith("adresse;latitude")
+    assert "Montbrun-Bocage" in north
+    assert south.startswith("rue;ville;latitude")
+    assert "Montbrun-Bocage" in south
+
+
+def test_csv_endpoint_with_several_files_and_fuzzy_queries(client, factory, slow_fuzzy):
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    factory(name="rue des bateaux", postcode="31310", city="Montbrun-Bocage")
+    files = []
+    for i, name in enumerate(["aviosn", "bataeux"] * 2):
+        file = io.BytesIO("adresse\nrue des {}\n".format(name).encode())
+        file.name = "file{}.csv".format(i)
+        files.append(file)
+    resp = client.post(
+        "/search/csv",
+        data={"data": files},
+        content_type="multipart/form-data",
+    )
+    assert resp.status == falcon.HTTP_200
+    with zipfile.ZipFile(io.BytesIO(resp.body)) as archive:
+        for i, name in enumerate(["avions", "bateaux"] * 2):
+            content = archive.read("file{}.geocoded.csv".format(i)).decode()
+            assert "rue des {} 31310".format(name) in content
+
+
+def test_csv_endpoint_with_zip_file(client, factory, config):
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    source = io.BytesIO()
+    with zipfile.ZipFile(source, "w") as archive:
+        archive.writestr("a/file.csv", "adresse\nrue des avions\n")
+        archive.writestr("b/file.csv", "adresse\nrue des voitures\n")
+        archive.writestr("__MACOSX/a/._file.csv", "junk")
+    files = {"data": (source.getvalue(), "region.zip")}
+    resp = client.post("/search/csv", files=files)
+    assert resp.status == falcon.HTTP_200
+    assert "region.geocoded.zip" in resp.headers["Content-Disposition"]
+    with zipfile.ZipFile(io.BytesIO(resp.body)) as archive:
+        assert archive.namelist() == ["file.geocoded.csv", "file-2.geocoded.csv"]
+        assert "Montbrun-Bocage" in archive.read("file.geocoded.csv").decode()
+    # Files in the archive are checked one by one.
+    source = io.BytesIO()
+    with zipfile.ZipFile(source, "w") as archive:
+        archive.writestr("file.csv", "adresse\nrue des avions\n")
+        archive.writestr("empty.csv", "")
+    files = {"data": (source.getvalue(), "region.zip")}
+    resp = client.post("/search/csv", files=files)
+    assert resp.status == falcon.HTTP_400
+    assert resp.json["title"] == "empty.csv: Empty file"
+    files = {"data": (b"not a zip", "region.zip")}
+    resp = client.post("/search/csv", files=files)
+    assert resp.status == falcon.HTTP_400
+
+
+def test_csv_endpoint_with_several_batches(client, factory, config):
+    config.CSV_BATCH_SIZE = 2
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    factory(name="rue des bateaux", postcode="31310", city="Montbrun-Bocage")
+    content = (
+        "adresse\n"
+        "rue des avions Montbrun\n"
+        "rue des bateaux Montbrun\n"
+        "rue des avions Montbrun\n"
+        "rue des voitures Montbrun\n"
+        "rue des bateaux\n"
+    )
+    resp = client.post(
+        "/search/csv/",
+        files={"data": (content, "file.csv")},
+        data={"columns": ["adresse"]},
+    )
+    assert resp.status == falcon.HTTP_200
+    assert resp.body.count("rue des avions 31310 Montbrun-Bocage") == 2
+    assert resp.body.count("rue des bateaux 31310 Montbrun-Bocage") == 2
+
+
+def test_batch_search_gives_same_results_as_search(factory):
+    from addok.core import search
+    from addok_csv import BatchSearch, PrefetchedToken, prefetch_frequencies
+
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    factory(name="rue des avions", postcode="09350", city="Fornex")
+    queries = ["rue des avions fornex", "avions 31310", "rue des voitures"]
+    frequencies = prefetch_frequencies(queries)
+    for query in queries:
+        helper = BatchSearch(frequencies, autocomplete=False, limit=3)
+        results = helper(query)
+        assert all(isinstance(t, PrefetchedToken) for t in helper.tokens)
+        expected = search(query, autocomplete=False, limit=3)
+        assert [(r.id, r.score) for r in results] == [(r.id, r.score) for r in expected]
+
+
+def test_csv_endpoint_with_workers_keeps_rows_order(client, factory, config):
+    config.CSV_WORKERS = 4
+    config.CSV_BATCH_SIZE = 3
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    factory(name="rue des bateaux", postcode="31310", city="Montbrun-Bocage")
+    names = ["avions", "bateaux"] * 5
+    content = "adresse\n" + "\n".join("rue des {} Montbrun".format(n) for n in names)
+    resp = client.post(
+        "/search/csv/",
+        files={"data": (content, "file.csv")},
+        data={"columns": ["adresse"]},
+    )
+    assert resp.status == falcon.HTTP_200
+    lines = resp.body.splitlines()[1:]
+    assert len(lines) == 10
+    for name, line in zip(names, lines):
+        assert line.startswith("rue des {} Montbrun;".format(name))
+        assert "rue des {} 31310 Montbrun-Bocage".format(name) in line
+
+
+@pytest.fixture
+def slow_fuzzy(monkeypatch):
+    from addok.db import DB
+
+    sinter = DB.sinter
+
+    def slow_sinter(keys):
+        # Widen the window between fuzzy SADD, SINTER and DEL.
+        time.sleep(0.01)
+        return sinter(keys)
+
+    monkeypatch.setattr(DB, "sinter", slow_sinter, raising=False)
+
+
+def test_csv_endpoint_with_workers_and_fuzzy_queries(
+    client, factory, config, slow_fuzzy
+):
+    config.CSV_WORKERS = 4
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    factory(name="rue des bateaux", postcode="31310", city="Montbrun-Bocage")
+    names = ["aviosn", "bataeux"] * 4
+    content = "adresse\n" + "\n".join("rue des {}".format(n) for n in names)
+    resp = client.post(
+        "/search/csv/",
+        files={"data": (content, "file.csv")},
+        data={"columns": ["adresse"]},
+    )
+    assert resp.status == falcon.HTTP_200
+    lines = resp.body.splitlines()[1:]
+    assert resp.body.count("rue des avions 31310") == 4
+    assert resp.body.count("rue des bateaux 31310") == 4
+    for name, line in zip(names, lines):
+        assert line.startswith("rue des {};".format(name))
+
+
+def test_csv_endpoint_normalizes_and_filters_queries(client, factory, config):
+    config.CSV_STATUS_COLUMN = "result_status"
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    content = (
+        "adresse,ville\n"
+        "rue des avions,Montbrun\n"
+        "RUE  des Avions , montbrun\n"
+        "--,\n"
+        ",\n"
+        "rue des voitures,Lyon\n"
+    )
+    resp = client.post("/search/csv", files={"data": (content, "file.csv")})
+    assert resp.status == falcon.HTTP_200
+    # Equivalent queries are searched once, junk ones not at all.
+    assert resp.headers["X-Dedup-Misses"] == "2"
+    assert resp.headers["X-Dedup-Hits"] == "1"
+    assert resp.headers["X-Rows-Empty"] == "2"
+    statuses = [line.split(",")[-1] for line in resp.body.splitlines()]
+    assert statuses == [
+        "result_status",
+        "matched",
+        "matched",
+        "empty",
+        "empty",
+        "notfound",
+    ]
+
+
+def test_csv_endpoint_with_oversize_queries(client, factory, config):
+    config.QUERY_MAX_LENGTH = 20
+    config.CSV_STATUS_COLUMN = "result_status"
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    content = "adresse\n" "rue des avions Montbrun-Bocage\n" "rue des avions\n"
+    files = {"data": (content, "file.csv")}
+    config.CSV_OVERSIZE = "truncate"
+    resp = client.post("/search/csv", files=files, data={"delimiter": ","})
+    assert resp.status == falcon.HTTP_200
+    assert resp.headers["X-Rows-Oversize"] == "1"
+    lines = resp.body.splitlines()
+    assert lines[1].endswith(",truncated")
+    assert "rue des avions 31310 Montbrun-Bocage" in lines[1]
+    assert lines[2].endswith(",matched")
+    config.CSV_OVERSIZE = "skip"
+    resp = client.post("/search/csv", files=files, data={"delimiter": ","})
+    assert resp.status == falcon.HTTP_200
+    lines = resp.body.splitlines()
+    assert lines[1] == "rue des avions Montbrun-Bocage,,,,,,,,,,,,,,too_long"
+    # Length is checked once transliterated: 12 characters, 44 in ascii.
+    files = {"data": ("adresse\n北京市朝阳区建国路88号\n", "file.csv")}
+    config.CSV_OVERSIZE = "truncate"
+    resp = client.post("/search/csv", files=files, data={"delimiter": ","})
+    assert resp.status == falcon.HTTP_200
+    assert resp.body.splitlines()[1].endswith(",truncated")
+    config.CSV_OVERSIZE = "skip"
+    resp = client.post("/search/csv", files=files, data={"delimiter": ","})
+    assert resp.status == falcon.HTTP_200
+    assert resp.body.splitlines()[1].endswith(",too_long")
+
+
+def test_query_too_large_with_workers_should_raise(client, factory, config):
+    config.QUERY_MAX_LENGTH = 30
+    config.CSV_WORKERS = 4
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    content = (
+        "adresse\n"
+        "rue des avions\n"
+        "rue des avions\n"
+        "rue des avions 31310 Montbrun-Bocage\n"
+        "rue des avions 31310 Montbrun-Bocage\n"
+    )
+    resp = client.post("/search/csv", files={"data": (content, "file.csv")})
+    assert resp.status == falcon.HTTP_413
+    assert resp.json["title"] == (
+        "Query too long, 36 chars, limit is 30 (row number 3)"
+    )
+
+
+def test_csv_endpoint_reuses_results_of_duplicate_rows(client, factory):
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    content = (
+        "adresse,code postal\n"
+        "rue des avions,31310\n"
+        "rue des avions,31310\n"
+        "rue des avions,09350\n"
+        "rue des avions,31310\n"
+    )
+    resp = client.post(
+        "/search/csv/",
+        files={"data": (content, "file.csv")},
+        data={"columns": ["adresse"], "postcode": "code postal"},
+    )
+    assert resp.status == falcon.HTTP_200
+    assert resp.body.count("rue des avions 31310 Montbrun-Bocage") == 3
+    assert resp.headers["X-Dedup-Hits"] == "2"
+    assert resp.headers["X-Dedup-Misses"] == "2"
+
+
+def test_csv_reverse_endpoint_reuses_results_of_duplicate_rows(client, factory):
+    factory(
+        name="rue des brûlés",
+        postcode="31310",
+        city="Montbrun-Bocage",
+        lat=10.22334401,
+        lon=12.33445501,
+    )
+    content = "latitude,longitude\n" + "10.223344,12.334455\n" * 3
+    resp = client.post("/reverse/csv/", files={"data": (content, "file.csv")})
+    assert resp.status == falcon.HTTP_200
+    assert resp.body.count("rue des brûlés 31310 Montbrun-Bocage") == 3
+    assert resp.headers["X-Dedup-Hits"] == "2"
+    assert resp.headers["X-Dedup-Misses"] == "1"
+
+
+def test_csv_reverse_grouping_gives_same_results(client, factory, config):
+    factory(
+        name="rue des brûlés",
+        postcode="31310",
+        city="Montbrun-Bocage",
+        lat=10.22334401,
+        lon=12.33445501,
+        housenumbers={"118": {"lat": 10.22334401, "lon": 12.33445501}},
+    )
+    factory(name="rue des avions", lat=10.2234, lon=12.3345)
+    content = (
+        "latitude,longitude,object\n"
+        "10.223344,12.334455,street\n"
+        "10.223344,12.334455,housenumber\n"
+        "10.2234,12.3345,street\n"
+        "invalid,12.3345,street\n"
+        "10.2233,12.3344,street\n"
+    )
+    files = {"data": (content, "file.csv")}
+    expected = client.post("/reverse/csv/", files=files, data={"type": "object"})
+    config.CSV_REVERSE_GROUPING = True
+    resp = client.post("/reverse/csv/", files=files, data={"type": "object"})
+    assert resp.status == falcon.HTTP_200
+    assert resp.body == expected.body
+    assert "invalid,12.3345,street,,,,,,,,,,," in resp.body
+    assert resp.body.count("rue des avions") == 2
+
+
+def test_csv_endpoint_reports_metrics(client, factory, config):
+    from addok_csv import METRICS
+
+    reported = []
+    config.CSV_METRICS_CALLBACKS = [lambda *args: reported.append(args)]
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    content = "adresse\n" "rue des avions\n" "\n" "rue des bateaux\n" '""\n'
+    before = METRICS["search.csv"].counters["matched"]
+    resp = client.post("/search/csv/", files={"data": (content, "file.csv")})
+    assert resp.status == falcon.HTTP_200
+    assert resp.headers["X-Rows"] == "3"
+    assert resp.headers["X-Rows-Matched"] == "1"
+    assert resp.headers["X-Rows-Not-Found"] == "1"
+    assert resp.headers["X-Rows-Empty"] == "1"
+    timing = resp.headers["Server-Timing"]
+    for stage in ("decode", "sniff", "parse", "geocode", "write", "encode"):
+        assert "{};dur=".format(stage) in timing
+    assert len(reported) == 1
+    endpoint, metrics = reported[0]
+    assert endpoint == "search.csv"
+    assert metrics.counters["rows"] == 3
+    assert METRICS["search.csv"].counters["matched"] == before + 1
+    resp = client.get("/csv/metrics")
+    assert resp.status == falcon.HTTP_200
+    assert 'addok_csv_matched_rows_total{endpoint="search.csv"}' in resp.body
+    assert 'addok_csv_stage_seconds_total{endpoint="search.csv",stage="geocode"}' in (
+        resp.body
+    )
+
+
+def test_csv_reverse_endpoint_reports_metrics(client, factory):
+    factory(name="rue des brûlés", lat=10.22334401, lon=12.33445501)
+    content = "lat,lon\n" "10.223344,12.334455\n" "invalid,12\n" "-40,-50\n"
+    resp = client.post("/reverse/csv/", files={"data": (content, "file.csv")})
+    assert resp.headers["X-Rows"] == "3"
+    assert resp.headers["X-Rows-Matched"] == "1"
+    assert resp.headers["X-Rows-Not-Found"] == "1"
+    assert resp.headers["X-Rows-Empty"] == "1"
+
+
+def test_csv_endpoint_publishes_progress(client, factory):
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    content = "adresse\n" "rue des avions\n" "rue des bateaux\n"
+    files = {"data": (content, "file.csv")}
+    form = {"progress_id": "my-file-1"}
+    resp = client.post("/search/csv/", files=files, data=form)
+    assert resp.status == falcon.HTTP_200
+    resp = client.get("/csv/progress/my-file-1")
+    assert resp.status == falcon.HTTP_200
+    assert resp.json["status"] == "done"
+    assert resp.json["rows"] == 2
+    assert resp.json["progress"] == 1
+    resp = client.get(
+        "/csv/progress/my-file-1", headers={"Accept": "text/event-stream"}
+    )
+    assert resp.headers["Content-Type"] == "text/event-stream"
+    assert resp.body.startswith("data: {")
+    assert '"status": "done"' in resp.body
+    assert client.get("/csv/progress/unknown").status == falcon.HTTP_404
+    resp = client.post("/search/csv/", files=files, data={"progress_id": "a/b"})
+    assert resp.status == falcon.HTTP_400
+
+
+def test_csv_endpoint_publishes_progress_of_spooled_file(
+    client, factory, config, monkeypatch
+):
+    from addok.db import DB
+
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    config.CSV_SPOOL_SIZE = 32
+    config.CSV_CHUNK_SIZE = 32
+    config.CSV_BATCH_SIZE = 1
+    config.CSV_PROGRESS_INTERVAL = 0
+    published = []
+    set = DB.set
+
+    def record(key, value, **kwargs):
+        published.append(json.loads(value))
+        return set(key, value, **kwargs)
+
+    content = "adresse\n" + "rue des avions\n" * 10
+    files = {"data": (content, "file.csv")}
+    form = {"progress_id": "my-file-2"}
+    monkeypatch.setattr(DB, "set", record, raising=False)
+    resp = client.post("/search/csv/", files=files, data=form)
+    assert resp.status == falcon.HTTP_200
+    # Estimated from the bytes read, while streaming.
+    ratios = [data["progress"] for data in published]
+    assert all(ratio is not None for ratio in ratios)
+    assert 0 < ratios[len(ratios) // 2] < 1
+    assert ratios == sorted(ratios)
+    assert published[-1]["status"] == "done"
+    assert published[-1]["progress"] == 1
+
+
+def test_csv_endpoint_stream_size_only_computed_for_progress(
+    client, factory, config, monkeypatch
+):
+    from addok_csv import CSVSearch, JobFile
+
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    config.CSV_STREAM = True
+    sizes = []
+    compute_stream_size = CSVSearch.compute_stream_size
+
+    def record(self, req, file):
+        sizes.append(compute_stream_size(self, req, file))
+        return sizes[-1]
+
+    monkeypatch.setattr(CSVSearch, "compute_stream_size", record)
+    files = {"data": ("adresse\nrue des avions\n", "file.csv")}
+    resp = client.post("/search/csv/", files=files)
+    assert resp.status == falcon.HTTP_200
+    assert sizes == []
+    resp = client.post("/search/csv/", files=files, data={"progress_id": "sized"})
+    assert resp.status == falcon.HTTP_200
+    assert len(sizes) == 1
+    # Size of zip members is read from the archive, not by seeking.
+    source = io.BytesIO()
+    with zipfile.ZipFile(source, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("file.csv", "adresse\n" + "rue des avions\n" * 100)
+    files = [JobFile(source, "region.zip")]
+    (member,) = CSVSearch().expand_archives(files)
+    member.stream.seek = None
+    assert compute_stream_size(CSVSearch(), None, member) == 8 + 15 * 100
+
+
+def test_progress_events_stop_when_stalled(client, config):
+    from addok.db import DB
+
+    config.CSV_PROGRESS_INTERVAL = 0.01
+    config.CSV_PROGRESS_STALL = 0.05
+    # Processing died without updating its progress.
+    DB.set("csv|progress|stalled", json.dumps({"status": "running", "rows": 3}))
+    resp = client.get("/csv/progress/stalled", headers={"Accept": "text/event-stream"})
+    assert resp.status == falcon.HTTP_200
+    assert resp.body.count("data: ") >= 2
+    assert '"status": "running"' in resp.body
+
+
+def test_csv_endpoint_rate_limit(client, factory, config):
+    config.CSV_RATE_LIMITS = {"search.csv": 10}
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    # Burst of 10 calls, then 10 per second.
+    content = "adresse\n" + "".join("rue des avions {}\n".format(i) for i in range(13))
+    start = time.perf_counter()
+    resp = client.post("/search/csv/", files={"data": (content, "file.csv")})
+    assert resp.status == falcon.HTTP_200
+    assert time.perf_counter() - start >= 0.25
+    # Reverse is not limited.
+    content = "lat,lon\n" + "48.1,2.2\n" * 20
+    start = time.perf_counter()
+    resp = client.post("/reverse/csv/", files={"data": (content, "file.csv")})
+    assert time.perf_counter() - start < 0.25
+
+
+def test_batch_requests_back_off_when_interactive_requests_are_slow(
+    client, config, monkeypatch
+):
+    from addok_csv import Latency
+
+    from addok.db import DB
+
+    monkeypatch.setattr(Latency, "average", 0.0)
+    monkeypatch.setattr(Latency, "own", 1.0)
+    monkeypatch.setattr(Latency, "stepped", 0.0)
+    monkeypatch.setattr(Latency, "factor", 1.0)
+    published = []
+    set = DB.set
+
+    def record(key, value, **kwargs):
+        published.append(value)
+        return set(key, value, **kwargs)
+
+    monkeypatch.setattr(DB, "set", record, raising=False)
+    config.CSV_INTERACTIVE_LATENCY = 0.000001
+    client.get("/search/?q=rue")
+    assert Latency.own == 0.5
+    assert published == [0.5]
+    client.get("/search/?q=rue")
+    # Not stepped nor published again within the interval.
+    assert Latency.own == 0.5
+    assert published == [0.5]
+    Latency.stepped -= Latency.INTERVAL
+    client.post("/search/csv/", files={"data": ("q\nrue", "file.csv")})
+    assert Latency.own == 0.5  # Batch requests are not measured.
+    config.CSV_INTERACTIVE_LATENCY = 10
+    client.get("/search/?q=rue")
+    assert Latency.own == 0.55
+    assert published == [0.5, 0.55]
+    # Restarts from 1 once the published value has expired.
+    Latency.stepped -= Latency.TTL + 1
+    config.CSV_INTERACTIVE_LATENCY = 0.000001
+    client.get("/search/?q=rue")
+    assert Latency.own == 0.5
+
+    # Shared by the workers: a batch is slowed down by the requests served by
+    # the other ones.
+    DB.set(Latency.KEY, 0.25)
+    monkeypatch.setattr(Latency, "fetched", 0.0)
+    assert Latency.current() == 0.25
+
+
+def test_results_are_cached_across_requests(client, factory, config, monkeypatch):
+    from addok.db import DB
+    from addok_csv import CACHE, LRUCache
+
+    monkeypatch.setattr(CACHE, "maxsize", 10)
+    monkeypatch.setattr(CACHE, "data", LRUCache(10).data)
+    monkeypatch.setattr(CACHE, "hits", 0)
+    monkeypatch.setattr(CACHE, "version", None)
+    config.CSV_CACHE_VERSION_KEY = "csv_version"
+    DB.set("csv_version", "1")
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    files = {"data": ("adresse\nrue des avions", "file.csv")}
+    resp = client.post("/search/csv/", files=files)
+    assert resp.body.count("rue des avions 31310 Montbrun-Bocage") == 1
+    assert CACHE.hits == 0
+    resp = client.post("/search/csv/", files=files)
+    assert resp.body.count("rue des avions 31310 Montbrun-Bocage") == 1
+    assert CACHE.hits == 1
+    # Index has changed, cache must be dropped.
+    DB.set("csv_version", "2")
+    resp = client.post("/search/csv/", files=files)
+    assert resp.body.count("rue des avions 31310 Montbrun-Bocage") == 1
+    assert CACHE.hits == 1
+
+
+def test_lru_cache_evicts_oldest_and_expired_entries(monkeypatch):
+    from addok_csv import LRUCache
+
+    cache = LRUCache(2, ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)  # "b" is the least recently used.
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + 11)
+    assert cache.get("a") is None
+    assert cache.hits == 3
+    assert cache.misses == 2
+
+
+def wait_for_job(client, job_id):
+    for _ in range(100):
+        resp = client.get("/csv/jobs/{}".format(job_id))
+        if resp.json["status"] in ("done", "failed"):
+            return resp.json
+        time.sleep(0.05)
+    raise AssertionError("Job {} did not finish".format(job_id))
+
+
+def test_csv_job(client, factory, config, tmp_path):
+    config.CSV_JOBS_DIR = str(tmp_path)
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    content = (
+        "name,street,postcode,city\n"
+        "Boulangerie Brûlé,rue des avions,31310,Montbrun-Bocage"
+    )
+    files = {"data": (content, "file.csv")}
+    form = {"columns": ["street", "postcode", "city"]}
+    resp = client.post("/search/csv/jobs", data=form, files=files)
+    assert resp.status == falcon.HTTP_202
+    job_id = resp.json["id"]
+    assert resp.headers["Location"] == "/csv/jobs/{}".format(job_id)
+    status = wait_for_job(client, job_id)
+    assert status["status"] == "done"
+    assert status["rows"] == 1
+    assert status["progress"] == 1
+    assert status["counters"]["matched"] == 1
+    assert "geocode" in status["timings"]
+    resp = client.get("/csv/jobs/{}/result".format(job_id))
+    assert resp.status == falcon.HTTP_200
+    assert "file.geocoded.csv" in resp.headers["Content-Disposition"]
+    assert resp.body.startswith("\ufeffname,street,postcode,city,latitude")
+    assert resp.body.count("Montbrun-Bocage") == 3
+    assert resp.body.count("Boulangerie Brûlé") == 1
+
+
+def test_csv_reverse_job(client, factory, config, tmp_path):
+    config.CSV_JOBS_DIR = str(tmp_path)
+    factory(
+        name="rue des brûlés",
+        postcode="31310",
+        city="Montbrun-Bocage",
+        lat=10.22334401,
+        lon=12.33445501,
+    )
+    content = "latitude,longitude\n" "10.223344,12.334455"
+    resp = client.post("/reverse/csv/jobs", files={"data": (content, "file.csv")})
+    assert wait_for_job(client, resp.json["id"])["status"] == "done"
+    resp = client.get("/csv/jobs/{}/result".format(resp.json["id"]))
+    assert "rue des brûlés 31310 Montbrun-Bocage" in resp.body
+
+
+def test_csv_job_with_bad_column(client, config, tmp_path):
+    config.CSV_JOBS_DIR = str(tmp_path)
+    content = "name,street,postcode,city\n,,,"
+    resp = client.post(
+        "/search/csv/jobs",
+        files={"data": (content, "file.csv")},
+        data={"columns": "xxxxx"},
+    )
+    status = wait_for_job(client, resp.json["id"])
+    assert status["status"] == "failed"
+    assert "xxxxx" in status["error"]
+    resp = client.get("/csv/jobs/{}/result".format(resp.json["id"]))
+    assert resp.status == falcon.HTTP_409
+
+
+def test_csv_job_without_file(client, config, tmp_path):
+    config.CSV_JOBS_DIR = str(tmp_path)
+    resp = client.post("/search/csv/jobs", files={"other": ("x", "file.csv")})
+    assert resp.status == falcon.HTTP_400
+    assert not list(tmp_path.iterdir())
+
+
+def test_csv_job_with_invalid_multipart(client, config, tmp_path):
+    config.CSV_JOBS_DIR = str(tmp_path)
+    # Truncated body, eg. client gone during the upload.
+    body = "--xxx\r\nContent-Disposition: form-data; name=data; filename=f.csv\r\n"
+    resp = client.post(
+        "/search/csv/jobs",
+        body=body,
+        headers={"Content-Type": "multipart/form-data; boundary=xxx"},
+    )
+    assert resp.status == falcon.HTTP_400
+    assert not list(tmp_path.iterdir())
+
+
+def test_unknown_csv_job(client, config, tmp_path):
+    config.CSV_JOBS_DIR = str(tmp_path)
+    assert client.get("/csv/jobs/{}".format("0" * 32)).status == falcon.HTTP_404
+    assert client.get("/csv/jobs/../../etc").status == falcon.HTTP_404
+
+
+def test_interrupted_csv_job(client, config, tmp_path):
+
+    from addok_csv import Job
+
+    config.CSV_JOBS_DIR = str(tmp_path)
+    job = Job.create()
+    job.write("params.json", {"filename": "file.csv", "form": {}})
+    job.set_status("running", rows=10)
+    resp = client.get("/csv/jobs/{}".format(job.id))
+    assert resp.json["status"] == "running"
+    # Its process died, no sign of life since.
+    old = time.time() - 3 * config.CSV_JOBS_HEARTBEAT - 1
+    os.utime(job.path / "status.json", (old, old))
+    resp = client.get("/csv/jobs/{}".format(job.id))
+    assert resp.json["status"] == "failed"
+    assert resp.json["error"] == "Interrupted"
+    assert resp.json["rows"] == 10
+
+
+def test_old_csv_jobs_are_removed(client, config, tmp_path):
+
+    config.CSV_JOBS_DIR = str(tmp_path)
+    files = {"data": ("latitude,longitude\n10.2,12.3", "file.csv")}
+    resp = client.post("/reverse/csv/jobs", files=files)
+    old_id = resp.json["id"]
+    assert wait_for_job(client, old_id)["status"] == "done"
+    old = time.time() - config.CSV_JOBS_TTL - 1
+    os.utime(tmp_path / old_id / "status.json", (old, old))
+    resp = client.post("/reverse/csv/jobs", files=files)
+    assert wait_for_job(client, resp.json["id"])["status"] == "done"
+    assert client.get("/csv/jobs/{}".format(old_id)).status == falcon.HTTP_404
+    assert [p.name for p in tmp_path.iterdir()] == [resp.json["id"]]
+
+
+def test_csv_endpoint_resumes_from_checkpoint(client, factory, config, tmp_path):
+    from addok_csv import CSVSearch
+
+    config.CSV_CHECKPOINTS_DIR = str(tmp_path)
+    config.CSV_CHECKPOINT_INTERVAL = 2
+    config.CSV_BATCH_SIZE = 1
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    factory(name="rue des bateaux", postcode="31310", city="Montbrun-Bocage")
+    names = ["avions", "bateaux", "avions", "bateaux", "avions"]
+    content = "adresse\n" + "\n".join("rue des {}".format(n) for n in names)
+    files = {"data": (content, "file.csv")}
+    processed = []
+    process_row = CSVSearch.process_row
+
+    def crashing_process_row(self, req, row, filters, columns, index):
+        if index == 3:
+            raise RuntimeError("Worker killed")
+        processed.append(index)
+        return process_row(self, req, row, filters, columns, index)
+
+    CSVSearch.process_row = crashing_process_row
+    try:
+        try:
+            client.post("/search/csv/", files=files)
+        except RuntimeError:
+            pass
+        assert processed == [0, 1, 2]
+        # Rows written before the error have been checkpointed.
+        processed.clear()
+        CSVSearch.process_row = lambda self, *args: (
+            processed.append(args[-1]) or process_row(self, *args)
+        )
+        # A new progress id does not prevent resuming.
+        data = {"progress_id": "retry"}
+        resp = client.post("/search/csv/", files=files, data=data)
+    finally:
+        CSVSearch.process_row = process_row
+    assert resp.status == falcon.HTTP_200
+    assert processed == [3, 4]
+    lines = resp.body.splitlines()[1:]
+    assert len(lines) == 5
+    for name, line in zip(names, lines):
+        assert "rue des {} 31310 Montbrun-Bocage".format(name) in line
+    # Run is complete, checkpoint has been removed.
+    assert not list(tmp_path.iterdir())
+
+
+def test_checkpoint_ignores_partial_writes(config, tmp_path):
+    from addok_csv import Checkpoint
+
+    config.CSV_CHECKPOINTS_DIR = str(tmp_path)
+    config.CSV_CHECKPOINT_INTERVAL = 1
+    checkpoint = Checkpoint.open("key", ["q", "result_label"])
+    row = {"q": "rue", "result_label": "Rue\nMultiline"}
+    checkpoint.add([row])
+    # Another run can't use the same checkpoint at the same time.
+    assert Checkpoint.open("key", ["q", "result_label"]) is None
+    # Nor remove it, even if old.
+    old = time.time() - config.CSV_CHECKPOINTS_TTL - 1
+    for path in (tmp_path / "key").iterdir():
+        os.utime(path, (old, old))
+    Checkpoint.clean()
+    assert (tmp_path / "key" / "rows.csv").exists()
+    checkpoint.file.write(b"crashed while writ")
+    checkpoint.file.close()
+    checkpoint.lock.close()
+    checkpoint = Checkpoint.open("key", ["q", "result_label"])
+    assert checkpoint.rows == 1
+    assert list(checkpoint.saved()) == [row]
+    checkpoint.close(done=True)
+    assert not list(tmp_path.iterdir())
+
+
+def test_old_checkpoints_are_removed(config, tmp_path):
+    from addok_csv import Checkpoint
+
+    config.CSV_CHECKPOINTS_DIR = str(tmp_path)
+    config.CSV_CHECKPOINT_INTERVAL = 1
+    checkpoint = Checkpoint.open("old", ["q"])
+    checkpoint.add([{"q": "rue"}])
+    # Interrupted, never resumed.
+    checkpoint.close()
+    old = time.time() - config.CSV_CHECKPOINTS_TTL - 1
+    for path in (tmp_path / "old").iterdir():
+        os.utime(path, (old, old))
+    Checkpoint.open("new", ["q"]).close()
+    assert [p.name for p in tmp_path.iterdir()] == ["new"]
+
+
+def test_csv_endpoint_with_ndjson_format(client, factory):
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    content = "name,adresse\nBoulangerie Brûlé,rue des avions\nPâtisserie,rue\n"
+    resp = client.post(
+        "/search/csv",
+        files={"data": (content, "file.csv")},
+        data={"columns": ["adresse"], "format": "ndjson"},
+    )
+    assert resp.status == falcon.HTTP_200
+    assert resp.headers["Content-Type"] == "application/x-ndjson"
+    assert "file.geocoded.ndjson" in resp.headers["Content-Disposition"]
+    first, second = [json.loads(line) for line in resp.body.splitlines()]
+    assert first["name"] == "Boulangerie Brûlé"
+    assert isinstance(first["latitude"], float)
+    assert isinstance(first["result_score"], float)
+    assert first["result_label"] == "rue des avions 31310 Montbrun-Bocage"
+    assert second["name"] == "Pâtisserie"
+    assert second["latitude"] is None
+
+
+def test_csv_endpoint_with_ndjson_format_and_error(client, factory, config):
+    config.QUERY_MAX_LENGTH = 30
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    content = "adresse\nrue des avions\nrue des avions 31310 Montbrun-Bocage\n"
+    resp = client.post(
+        "/search/csv",
+        files={"data": (content, "file.csv")},
+        data={"format": "ndjson"},
+    )
+    # Status was sent with the first row.
+    assert resp.status == falcon.HTTP_200
+    first, error = [json.loads(line) for line in resp.body.splitlines()]
+    assert first["result_label"] == "rue des avions 31310 Montbrun-Bocage"
+    assert "row number 2" in error["error"]
+    # Error on the first row is still a proper response.
+    content = "adresse\nrue des avions 31310 Montbrun-Bocage\n"
+    resp = client.post(
+        "/search/csv",
+        files={"data": (content, "file.csv")},
+        data={"format": "ndjson"},
+    )
+    assert resp.status == falcon.HTTP_413
+
+
+def test_csv_reverse_endpoint_with_geojsonseq_format(client, factory):
+    factory(
+        name="rue des brûlés",
+        postcode="31310",
+        city="Montbrun-Bocage",
+        lat=10.22334401,
+        lon=12.33445501,
+    )
+    content = "latitude,longitude\n" "10.223344,12.334455\n" "invalid,\n"
+    resp = client.post(
+        "/reverse/csv/",
+        files={"data": (content, "file.csv")},
+        data={"format": "geojsonseq"},
+    )
+    assert resp.status == falcon.HTTP_200
+    assert resp.headers["Content-Type"] == "application/geo+json-seq"
+    assert "file.geocoded.geojsons" in resp.headers["Content-Disposition"]
+    records = resp.body.split("\x1e")
+    assert records[0] == ""
+    first, second = [json.loads(record) for record in records[1:]]
+    assert first["type"] == "Feature"
+    assert first["geometry"] == {
+        "type": "Point",
+        "coordinates": [12.33445501, 10.22334401],
+    }
+    assert first["properties"]["result_distance"] == 0
+    assert first["properties"]["result_label"] == "rue des brûlés 31310 Montbrun-Bocage"
+    assert first["properties"]["latitude"] == "10.223344"
+    assert second["geometry"] is None
+
+
+def test_csv_endpoint_with_unknown_format(client):
+    content = "name,adresse\nBoulangerie Brûlé,rue des avions\n"
+    resp = client.post(
+        "/search/csv",
+        files={"data": (content, "file.csv")},
+        data={"format": "xml"},
+    )
+    assert resp.status == falcon.HTTP_400
+
+
+def test_csv_endpoint_with_parquet_file(client, factory, config):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    table = pyarrow.table(
+        {
+            "name": ["Boulangerie Brûlé", "Pâtisserie", None],
+            "street": ["rue des avions", "rue des avions", "rue des voitures"],
+            "postcode": [31310, 31310, 9350],
+        }
+    )
+    source = io.BytesIO()
+    pyarrow.parquet.write_table(table, source)
+    resp = client.post(
+        "/search/csv",
+        files={"data": (source.getvalue(), "file.parquet")},
+        data={"columns": ["street", "postcode"], "postcode": "postcode"},
+    )
+    assert resp.status == falcon.HTTP_200
+    assert "file.geocoded.parquet" in resp.headers["Content-Disposition"]
+    assert resp.headers["Content-Type"] == "application/vnd.apache.parquet"
+    result = pyarrow.parquet.read_table(io.BytesIO(resp.body))
+    assert result.schema.field("postcode").type == pyarrow.int64()
+    assert result.schema.field("latitude").type == pyarrow.float64()
+    assert result.schema.field("result_score").type == pyarrow.float64()
+    assert result.schema.field("result_label").type == pyarrow.string()
+    rows = result.to_pylist()
+    assert rows[0]["name"] == "Boulangerie Brûlé"
+    assert rows[0]["result_label"] == "rue des avions 31310 Montbrun-Bocage"
+    assert rows[0]["latitude"] == 48.3254
+    assert rows[1]["result_label"] == "rue des avions 31310 Montbrun-Bocage"
+    assert rows[2]["name"] is None
+    assert rows[2]["result_label"] is None
+    # Spooled on disk, same result.
+    config.CSV_SPOOL_SIZE = 16
+    resp = client.post(
+        "/search/csv",
+        files={"data": (source.getvalue(), "file.parquet")},
+        data={"columns": ["street", "postcode"], "postcode": "postcode"},
+    )
+    assert pyarrow.parquet.read_table(io.BytesIO(resp.body)).to_pylist() == rows
+
+
+def test_csv_reverse_endpoint_with_arrow_file(client, factory, config, tmp_path):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.ipc
+
+    config.CSV_BATCH_SIZE = 1
+    factory(
+        name="rue des brûlés",
+        postcode="31310",
+        city="Montbrun-Bocage",
+        lat=10.22334401,
+        lon=12.33445501,
+    )
+    batch = pyarrow.record_batch(
+        {"lat": [10.223344, None], "lon": [12.334455, 12.334455]}
+    )
+    source = io.BytesIO()
+    with pyarrow.ipc.new_file(source, batch.schema) as writer:
+        writer.write_batch(batch)
+        writer.write_batch(batch)
+    resp = client.post(
+        "/reverse/csv", files={"data": (source.getvalue(), "file.arrow")}
+    )
+    assert resp.status == falcon.HTTP_200
+    result = pyarrow.ipc.open_file(io.BytesIO(resp.body)).read_all()
+    assert result.num_rows == 4
+    assert result.schema.field("result_distance").type == pyarrow.int64()
+    assert result.column("result_latitude").to_pylist() == [
+        10.22334401,
+        None,
+        10.22334401,
+        None,
+    ]
+
+
+def test_csv_endpoint_with_invalid_parquet_file(client):
+    pytest.importorskip("pyarrow")
+    resp = client.post("/search/csv", files={"data": ("a,b\n1,2", "file.parquet")})
+    assert resp.status == falcon.HTTP_400
+
+
+def test_csv_job_with_parquet_file(client, factory, config, tmp_path):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+
+    config.CSV_JOBS_DIR = str(tmp_path)
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    source = io.BytesIO()
+    pyarrow.parquet.write_table(pyarrow.table({"q": ["rue des avions"]}), source)
+    resp = client.post(
+        "/search/csv/jobs", files={"data": (source.getvalue(), "file.parquet")}
+    )
+    assert wait_for_job(client, resp.json["id"])["status"] == "done"
+    resp = client.get("/csv/jobs/{}/result".format(resp.json["id"]))
+    assert "file.geocoded.parquet" in resp.headers["Content-Disposition"]
+    result = pyarrow.parquet.read_table(io.BytesIO(resp.body)).to_pylist()
+    assert result[0]["result_label"] == "rue des avions 31310 Montbrun-Bocage"
+
+
+def test_warmup(client, factory, config, capsys):
+    factory(name="rue de la gare", postcode="31310", city="Montbrun-Bocage")
+    config.CSV_WARMUP = True
+    addok_csv.on_load()
+    assert list(addok_csv.WARMUP) == ["redis", "search", "reverse"]
+    assert "CSV warmup done" in capsys.readouterr().out
+    resp = client.get("/csv/metrics")
+    assert 'addok_csv_warmup_seconds{step="search"}' in resp.body
+    config.CSV_WARMUP = False
+    addok_csv.on_load()
+    assert not addok_csv.WARMUP
+
+
+def test_csv_endpoint_logs_slowest_rows(client, factory, config, caplog):
+    factory(name="rue des avions", postcode="31310", city="Montbrun-Bocage")
+    config.CSV_SLOW_ROWS = 2
+    content = (
+        "adresse,cp\n"
+        "rue des avions,31310\n"
+        "rue des avions,31310\n"
+        "avions,31310\n"
+        "rue,\n"
+    )
+    with caplog.at_level("DEBUG", logger="csv_slow"):
+        resp = client.post(
+            "/search/csv",
+            files={"data": (content, "file.csv")},
+            data={"columns": ["adresse"], "postcode": "cp"},
+        )
+    assert resp.status == falcon.HTTP_200
+    # Duplicated rows call the engine once, only the two slowest are kept.
+    records = [r.getMessage().split("\t") for r in caplog.records]
+    assert len(records) == 2
+    assert all(record[0] == "search.csv" for record in records)
+    assert float(records[0][1]) >= float(records[1][1])
+    queries = {"rue des avions", "avions", "rue"}
+    assert all(record[2] in queries for record in records)